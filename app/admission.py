@@ -0,0 +1,142 @@
+import math
+import time
+from collections import OrderedDict
+
+from fastapi import HTTPException, Request
+from starlette import status
+
+from app.config import (
+    AUTH_BURST_PER_IP,
+    AUTH_BURST_PER_USERNAME,
+    AUTH_MAX_CONCURRENCY,
+    AUTH_RATE_PER_IP,
+    AUTH_RATE_PER_USERNAME,
+    RATE_LIMIT_MAX_KEYS,
+)
+from app.metrics import admission_rejections, registry
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float, max_keys: int = 100_000):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_keys = max_keys
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+
+    def acquire(self, key: str) -> float:
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens >= 1:
+            tokens -= 1
+            retry_after = 0.0
+        else:
+            retry_after = (1 - tokens) / self.rate
+        self._buckets[key] = (tokens, now)
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return retry_after
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class ConcurrencyLimiter:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+
+    def try_acquire(self) -> bool:
+        if self.limit > 0 and self.active >= self.limit:
+            return False
+        self.active += 1
+        return True
+
+    def release(self):
+        self.active -= 1
+
+
+def _reject(status_code: int, detail: str, retry_after: float):
+    return HTTPException(
+        status_code=status_code,
+        detail=detail,
+        headers={"Retry-After": str(max(math.ceil(retry_after), 1))},
+    )
+
+
+class AdmissionControl:
+    def __init__(
+        self,
+        name: str,
+        per_ip: TokenBucket,
+        per_username: TokenBucket,
+        limiter: ConcurrencyLimiter,
+    ):
+        self.name = name
+        self.per_ip = per_ip
+        self.per_username = per_username
+        self.limiter = limiter
+
+    async def __call__(self, request: Request):
+        client = request.client.host if request.client else "unknown"
+        retry_after = self.per_ip.acquire(client)
+        if retry_after:
+            admission_rejections.inc(self.name, "ip_rate")
+            raise _reject(
+                status.HTTP_429_TOO_MANY_REQUESTS,
+                "Too many requests",
+                retry_after,
+            )
+        if not self.limiter.try_acquire():
+            admission_rejections.inc(self.name, "concurrency")
+            raise _reject(
+                status.HTTP_503_SERVICE_UNAVAILABLE,
+                "Server is busy",
+                1,
+            )
+        try:
+            yield
+        finally:
+            self.limiter.release()
+
+    def check_username(self, username: str):
+        retry_after = self.per_username.acquire(username.lower())
+        if retry_after:
+            admission_rejections.inc(self.name, "username_rate")
+            raise _reject(
+                status.HTTP_429_TOO_MANY_REQUESTS,
+                "Too many attempts for this username",
+                retry_after,
+            )
+
+    def stats(self):
+        return {
+            "active": self.limiter.active,
+            "limit": self.limiter.limit,
+            "tracked_ips": len(self.per_ip),
+            "tracked_usernames": len(self.per_username),
+        }
+
+
+def build_admission(name: str, limiter: ConcurrencyLimiter):
+    admission = AdmissionControl(
+        name,
+        TokenBucket(AUTH_RATE_PER_IP, AUTH_BURST_PER_IP, RATE_LIMIT_MAX_KEYS),
+        TokenBucket(
+            AUTH_RATE_PER_USERNAME,
+            AUTH_BURST_PER_USERNAME,
+            RATE_LIMIT_MAX_KEYS,
+        ),
+        limiter,
+    )
+    registry.register_stats("admission", admission.stats, {"endpoint": name})
+    return admission
+
+
+# Login and registration both cost a bcrypt operation, so they share one
+# concurrency limit.
+auth_limiter = ConcurrencyLimiter(AUTH_MAX_CONCURRENCY)
+login_admission = build_admission("login", auth_limiter)
+register_admission = build_admission("register", auth_limiter)
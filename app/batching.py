@@ -0,0 +1,137 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+logger = logging.getLogger(__name__)
+
+FlushFunc = Callable[[Any, list[Any]], Awaitable[list[Any]]]
+
+
+class WriteBatcher:
+    def __init__(
+        self,
+        flush: FlushFunc,
+        max_items: int = 100,
+        max_delay: float = 0.005,
+    ):
+        self.flush = flush
+        self.max_items = max_items
+        self.max_delay = max_delay
+        self.batches = 0
+        self.items = 0
+        self.errors = 0
+        self.max_batch_size = 0
+        self.flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _get_queue(self) -> asyncio.Queue:
+        loop = asyncio.get_running_loop()
+        if (
+            self._queue is None
+            or self._loop is not loop
+            or self._worker is None
+            or self._worker.done()
+        ):
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._run(self._queue))
+        return self._queue
+
+    async def submit(self, target: Hashable, item: Any) -> Any:
+        future = asyncio.get_running_loop().create_future()
+        self._get_queue().put_nowait((target, item, future))
+        return await future
+
+    async def _collect(self, queue: asyncio.Queue):
+        batch = [await queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_delay
+        while len(batch) < self.max_items:
+            if not queue.empty():
+                batch.append(queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self, queue: asyncio.Queue):
+        batch: list[tuple[Hashable, Any, asyncio.Future]] = []
+        try:
+            while True:
+                batch = await self._collect(queue)
+                groups: dict[Hashable, list[tuple[Any, asyncio.Future]]] = {}
+                for target, item, future in batch:
+                    groups.setdefault(target, []).append((item, future))
+                for target, entries in groups.items():
+                    await self._flush_group(target, entries)
+                batch = []
+        finally:
+            for _, _, future in batch:
+                if not future.done():
+                    future.cancel()
+            while not queue.empty():
+                _, _, future = queue.get_nowait()
+                future.cancel()
+
+    async def _flush_group(
+        self,
+        target: Hashable,
+        entries: list[tuple[Any, asyncio.Future]],
+    ):
+        start = time.perf_counter()
+        try:
+            results = await self.flush(target, [item for item, _ in entries])
+        except Exception as exc:
+            self.errors += 1
+            logger.warning("Write batch of %s failed: %s", len(entries), exc)
+            for _, future in entries:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+        finally:
+            flush_time = time.perf_counter() - start
+            self.batches += 1
+            self.items += len(entries)
+            self.max_batch_size = max(self.max_batch_size, len(entries))
+            self.flush_seconds += flush_time
+            self.max_flush_seconds = max(self.max_flush_seconds, flush_time)
+        for (_, future), result in zip(entries, results):
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self):
+        return {
+            "max_items": self.max_items,
+            "max_delay": self.max_delay,
+            "pending": self._queue.qsize() if self._queue is not None else 0,
+            "batches": self.batches,
+            "items": self.items,
+            "errors": self.errors,
+            "max_batch_size": self.max_batch_size,
+            "avg_batch_size": self.items / self.batches if self.batches else 0,
+            "flush_seconds": self.flush_seconds,
+            "max_flush_seconds": self.max_flush_seconds,
+        }
+
+    async def close(self):
+        if self._worker is not None and not self._worker.done():
+            self._worker.cancel()
+            if self._loop is not asyncio.get_running_loop():
+                self._worker = None
+                self._queue = None
+                return
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+        self._worker = None
+        self._queue = None
@@ -0,0 +1,222 @@
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+from app.config import (
+    CACHE_BACKEND,
+    CACHE_LOCAL_SIZE,
+    CACHE_REDIS_URL,
+    CACHE_TTL,
+)
+
+logger = logging.getLogger(__name__)
+
+STATS_COUNTERS = (
+    "hits",
+    "misses",
+    "evictions",
+    "expirations",
+    "shared_hits",
+    "shared_misses",
+    "shared_errors",
+)
+
+_missing = object()
+
+
+class LocalCache:
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def _lookup(self, key: Hashable) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            return _missing
+        expires_at, value = item
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self.expirations += 1
+            return _missing
+        return value
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        value = self._lookup(key)
+        if value is _missing:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0 or self.maxsize <= 0:
+            self.delete(key)
+            return
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key: Hashable):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+    def __contains__(self, key: Hashable):
+        return self._lookup(key) is not _missing
+
+    def __len__(self):
+        return len(self._data)
+
+
+class RedisBackend:
+    def __init__(self, url: str):
+        self.url = url
+        self.errors = 0
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            from redis import asyncio as aioredis
+
+            self._client = aioredis.from_url(
+                self.url, encoding="utf8", decode_responses=True
+            )
+        return self._client
+
+    async def get_many(self, keys: list[str]) -> list[Optional[str]]:
+        try:
+            return await self.client.mget(keys)
+        except Exception as exc:
+            self.errors += 1
+            logger.warning("Shared cache read failed: %s", exc)
+            return [None] * len(keys)
+
+    async def set_many(self, items: dict[str, tuple[str, float]]):
+        try:
+            async with self.client.pipeline(transaction=False) as pipe:
+                for key, (value, ttl) in items.items():
+                    pipe.set(key, value, ex=max(int(ttl), 1))
+                await pipe.execute()
+        except Exception as exc:
+            self.errors += 1
+            logger.warning("Shared cache write failed: %s", exc)
+
+    async def delete(self, key: str):
+        try:
+            await self.client.delete(key)
+        except Exception as exc:
+            self.errors += 1
+            logger.warning("Shared cache delete failed: %s", exc)
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+
+class TieredCache:
+    def __init__(
+        self,
+        namespace: str,
+        local: LocalCache,
+        shared: Optional[RedisBackend] = None,
+    ):
+        self.namespace = namespace
+        self.local = local
+        self.shared = shared
+        self.shared_hits = 0
+        self.shared_misses = 0
+
+    def _key(self, key: str):
+        return f"{self.namespace}:{key}"
+
+    async def get(self, key: str) -> Optional[str]:
+        return (await self.get_many([key]))[key]
+
+    async def get_many(self, keys: list[str]) -> dict[str, Optional[str]]:
+        found = {key: self.local.get(key) for key in keys}
+        missing = [key for key, value in found.items() if value is None]
+        if missing and self.shared is not None:
+            values = await self.shared.get_many(
+                [self._key(key) for key in missing]
+            )
+            for key, value in zip(missing, values):
+                if value is None:
+                    self.shared_misses += 1
+                    continue
+                self.shared_hits += 1
+                self.local.set(key, value)
+                found[key] = value
+        return found
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = None):
+        await self.set_many({key: value}, ttl)
+
+    async def set_many(
+        self,
+        items: dict[str, str],
+        ttl: Optional[float] = None,
+        ttls: Optional[dict[str, float]] = None,
+    ):
+        shared = {}
+        for key, value in items.items():
+            key_ttl = ttls.get(key, ttl) if ttls else ttl
+            self.local.set(key, value, key_ttl)
+            if key_ttl is None:
+                key_ttl = self.local.ttl
+            if key_ttl > 0:
+                shared[self._key(key)] = (value, key_ttl)
+        if self.shared is not None and shared:
+            await self.shared.set_many(shared)
+
+    async def delete(self, key: str):
+        self.local.delete(key)
+        if self.shared is not None:
+            await self.shared.delete(self._key(key))
+
+    def stats(self):
+        stats = self.local.stats()
+        if self.shared is not None:
+            stats["shared_hits"] = self.shared_hits
+            stats["shared_misses"] = self.shared_misses
+            stats["shared_errors"] = self.shared.errors
+        return stats
+
+    async def close(self):
+        if self.shared is not None:
+            await self.shared.close()
+
+
+def build_cache(namespace: str):
+    shared = None
+    if CACHE_BACKEND == "redis":
+        shared = RedisBackend(CACHE_REDIS_URL)
+    elif CACHE_BACKEND != "local":
+        raise ValueError(f"Unknown cache backend: {CACHE_BACKEND}")
+    return TieredCache(
+        namespace,
+        LocalCache(maxsize=CACHE_LOCAL_SIZE, ttl=CACHE_TTL),
+        shared,
+    )
@@ -6,3 +6,115 @@ SECRET_KEY = os.getenv(
 )
 ALGORITHM = os.getenv("ALGORITHM", "HS256")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", 30))
+
+PASSWORD_HASH_EXECUTOR = os.getenv("PASSWORD_HASH_EXECUTOR", "thread")
+PASSWORD_HASH_WORKERS = int(
+    os.getenv("PASSWORD_HASH_WORKERS", os.cpu_count() or 1)
+)
+PASSWORD_HASH_QUEUE_SIZE = int(
+    os.getenv("PASSWORD_HASH_QUEUE_SIZE", PASSWORD_HASH_WORKERS * 16)
+)
+
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", 10000))
+PRINCIPAL_CACHE_TTL = float(os.getenv("PRINCIPAL_CACHE_TTL", 60))
+
+REFFERALS_PAGE_SIZE = int(os.getenv("REFFERALS_PAGE_SIZE", 100))
+REFFERALS_PAGE_MAX = int(os.getenv("REFFERALS_PAGE_MAX", 1000))
+REFFERALS_STREAM_CHUNK = int(os.getenv("REFFERALS_STREAM_CHUNK", 500))
+
+DOWNLINE_MAX_DEPTH = int(os.getenv("DOWNLINE_MAX_DEPTH", 10))
+DOWNLINE_MEMBERS_MAX = int(os.getenv("DOWNLINE_MEMBERS_MAX", 1000))
+UPLINE_MAX_DEPTH = int(os.getenv("UPLINE_MAX_DEPTH", 10))
+REFFERALS_CACHE_MAX_AGE = int(os.getenv("REFFERALS_CACHE_MAX_AGE", 0))
+
+REFFERAL_CODE_SWEEP_INTERVAL = float(
+    os.getenv("REFFERAL_CODE_SWEEP_INTERVAL", 60)
+)
+REFFERAL_CODE_SWEEP_CHUNK = int(os.getenv("REFFERAL_CODE_SWEEP_CHUNK", 500))
+REFFERAL_CODE_LOOKUP_MAX = int(os.getenv("REFFERAL_CODE_LOOKUP_MAX", 5000))
+
+WEB_HOST = os.getenv("WEB_HOST", "127.0.0.1")
+WEB_PORT = int(os.getenv("WEB_PORT", 8000))
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", os.cpu_count() or 1))
+
+INVALIDATION_BUS = os.getenv("INVALIDATION_BUS", "false").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+INVALIDATION_POLL_INTERVAL = (
+    float(os.getenv("INVALIDATION_POLL_INTERVAL_MS", 20)) / 1000
+)
+INVALIDATION_RETENTION = float(os.getenv("INVALIDATION_RETENTION", 300))
+
+IMPORT_API_KEY = os.getenv("IMPORT_API_KEY", "")
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", 1000))
+
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "local")
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL", "redis://localhost")
+CACHE_LOCAL_SIZE = int(os.getenv("CACHE_LOCAL_SIZE", 10000))
+CACHE_TTL = float(os.getenv("CACHE_TTL", 60))
+
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./app.py.db")
+DATABASE_ECHO = os.getenv("DATABASE_ECHO", "").lower() in ("1", "true", "yes")
+DATABASE_POOL_SIZE = int(os.getenv("DATABASE_POOL_SIZE", 5))
+DATABASE_MAX_OVERFLOW = int(os.getenv("DATABASE_MAX_OVERFLOW", 10))
+DATABASE_POOL_TIMEOUT = float(os.getenv("DATABASE_POOL_TIMEOUT", 30))
+SQLITE_PRAGMAS = {
+    "journal_mode": os.getenv("SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": os.getenv("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "mmap_size": int(os.getenv("SQLITE_MMAP_SIZE", 256 * 1024 * 1024)),
+    "cache_size": int(os.getenv("SQLITE_CACHE_SIZE", -64 * 1024)),
+    "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT", 5000)),
+    "temp_store": os.getenv("SQLITE_TEMP_STORE", "MEMORY"),
+}
+
+DATABASE_SPLIT_READS = os.getenv("DATABASE_SPLIT_READS", "true").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+DATABASE_READ_POOL_SIZE = int(
+    os.getenv("DATABASE_READ_POOL_SIZE", (os.cpu_count() or 1) * 2)
+)
+DATABASE_WRITE_TIMEOUT = float(os.getenv("DATABASE_WRITE_TIMEOUT", 60))
+SCHEMA_CHECK = os.getenv("SCHEMA_CHECK", "version")
+
+REGISTRATION_BATCHING = os.getenv(
+    "REGISTRATION_BATCHING", "false"
+).lower() in ("1", "true", "yes")
+REGISTRATION_BATCH_SIZE = int(os.getenv("REGISTRATION_BATCH_SIZE", 100))
+REGISTRATION_BATCH_DELAY = (
+    float(os.getenv("REGISTRATION_BATCH_DELAY_MS", 5)) / 1000
+)
+
+QUERY_PROFILING = os.getenv("QUERY_PROFILING", "false").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+QUERY_BUDGET_MODE = os.getenv("QUERY_BUDGET_MODE", "warn")
+QUERY_BUDGET_DEFAULT = int(os.getenv("QUERY_BUDGET_DEFAULT", 0))
+QUERY_BUDGETS = os.getenv("QUERY_BUDGETS", "")
+QUERY_REPEAT_THRESHOLD = int(os.getenv("QUERY_REPEAT_THRESHOLD", 3))
+QUERY_SLOW_LOG = os.getenv("QUERY_SLOW_LOG", "")
+# Off unless a slow-query log file is configured.
+QUERY_SLOW_MS = float(os.getenv("QUERY_SLOW_MS", 100 if QUERY_SLOW_LOG else 0))
+
+AUTH_RATE_PER_IP = float(os.getenv("AUTH_RATE_PER_IP", 5))
+AUTH_BURST_PER_IP = float(os.getenv("AUTH_BURST_PER_IP", 20))
+AUTH_RATE_PER_USERNAME = float(os.getenv("AUTH_RATE_PER_USERNAME", 0.2))
+AUTH_BURST_PER_USERNAME = float(os.getenv("AUTH_BURST_PER_USERNAME", 5))
+AUTH_MAX_CONCURRENCY = int(
+    os.getenv("AUTH_MAX_CONCURRENCY", PASSWORD_HASH_QUEUE_SIZE)
+)
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", 100_000))
+
+PASSWORD_SCHEMES = [
+    scheme.strip()
+    for scheme in os.getenv("PASSWORD_SCHEMES", "bcrypt").split(",")
+    if scheme.strip()
+]
+PASSWORD_ROUNDS = int(os.getenv("PASSWORD_ROUNDS", 0))
+PASSWORD_TARGET_MS = float(os.getenv("PASSWORD_TARGET_MS", 0))
+PASSWORD_MIN_ROUNDS = int(os.getenv("PASSWORD_MIN_ROUNDS", 0))
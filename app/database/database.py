@@ -1,14 +1,155 @@
+import time
+from typing import Any, Optional
+
+from sqlalchemy import URL, event, make_url
 from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
     AsyncSession,
     async_sessionmaker,
     create_async_engine,
 )
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
-DATABASE_URL = "sqlite+aiosqlite:///./app.py.db"
-
-engine = create_async_engine(DATABASE_URL, echo=True)
-async_session = async_sessionmaker(
-    engine, class_=AsyncSession, expire_on_commit=False
+from app.config import (
+    DATABASE_ECHO,
+    DATABASE_MAX_OVERFLOW,
+    DATABASE_POOL_SIZE,
+    DATABASE_POOL_TIMEOUT,
+    DATABASE_READ_POOL_SIZE,
+    DATABASE_SPLIT_READS,
+    DATABASE_URL,
+    DATABASE_WRITE_TIMEOUT,
+    SQLITE_PRAGMAS,
 )
+from app.metrics import db_pool_wait, instrument_engine
+
+
+class InstrumentedQueuePool(AsyncAdaptedQueuePool):
+    metrics_name = "default"
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            db_pool_wait.observe(
+                time.perf_counter() - start, self.metrics_name
+            )
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.metrics_name = self.metrics_name
+        return pool
+
+
+class RoutedSessionmaker(async_sessionmaker):
+    def __init__(
+        self,
+        bind: AsyncEngine,
+        reader: Optional[async_sessionmaker] = None,
+        **kwargs,
+    ):
+        super().__init__(bind, **kwargs)
+        self.reader = reader if reader is not None else self
+
+
+def read_session(async_session: async_sessionmaker) -> async_sessionmaker:
+    return getattr(async_session, "reader", async_session)
+
+
+def is_memory_database(url: str | URL):
+    return make_url(url).database in (None, "", ":memory:")
+
+
+def read_only_url(url: str | URL) -> URL:
+    url = make_url(url)
+    return url.set(
+        database=f"file:{url.database}",
+        query={**url.query, "mode": "ro", "uri": "true"},
+    )
+
+
+def create_engine(
+    url: str | URL = DATABASE_URL,
+    pragmas: Optional[dict[str, Any]] = None,
+    name: str = "default",
+    **kwargs,
+) -> AsyncEngine:
+    options: dict[str, Any] = {"echo": DATABASE_ECHO}
+    if not is_memory_database(url):
+        options.update(
+            poolclass=InstrumentedQueuePool,
+            pool_size=DATABASE_POOL_SIZE,
+            max_overflow=DATABASE_MAX_OVERFLOW,
+            pool_timeout=DATABASE_POOL_TIMEOUT,
+        )
+    options.update(kwargs)
+    engine = create_async_engine(url, **options)
+    if isinstance(engine.pool, InstrumentedQueuePool):
+        engine.pool.metrics_name = name
+    instrument_engine(engine, name)
+    pragmas = SQLITE_PRAGMAS if pragmas is None else pragmas
+    if make_url(url).get_backend_name() == "sqlite" and pragmas:
+
+        @event.listens_for(engine.sync_engine, "connect")
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas.items():
+                cursor.execute(f"PRAGMA {name}={value}")
+            cursor.close()
+
+    return engine
+
+
+def create_read_engine(url: str | URL = DATABASE_URL, **kwargs) -> AsyncEngine:
+    pragmas = {
+        name: value
+        for name, value in SQLITE_PRAGMAS.items()
+        if name != "journal_mode"
+    }
+    options: dict[str, Any] = {
+        "pool_size": DATABASE_READ_POOL_SIZE,
+        "max_overflow": 0,
+    }
+    options.update(kwargs)
+    return create_engine(
+        read_only_url(url), pragmas=pragmas, name="read", **options
+    )
+
+
+def create_sessionmaker(
+    url: str | URL = DATABASE_URL,
+    split_reads: bool = DATABASE_SPLIT_READS,
+) -> RoutedSessionmaker:
+    if not split_reads or is_memory_database(url):
+        return RoutedSessionmaker(
+            create_engine(url), class_=AsyncSession, expire_on_commit=False
+        )
+    reader = async_sessionmaker(
+        create_read_engine(url), class_=AsyncSession, expire_on_commit=False
+    )
+    return RoutedSessionmaker(
+        create_engine(
+            url,
+            name="write",
+            pool_size=1,
+            max_overflow=0,
+            pool_timeout=DATABASE_WRITE_TIMEOUT,
+        ),
+        reader=reader,
+        class_=AsyncSession,
+        expire_on_commit=False,
+    )
+
+
+async def dispose_sessionmaker(async_session: async_sessionmaker):
+    await async_session.kw["bind"].dispose()
+    reader = read_session(async_session)
+    if reader is not async_session:
+        await reader.kw["bind"].dispose()
+
+
+async_session = create_sessionmaker()
+engine = async_session.kw["bind"]
 Base = declarative_base()
@@ -0,0 +1,250 @@
+from datetime import datetime, timezone
+import hashlib
+import logging
+
+from sqlalchemy import (
+    Connection,
+    DateTime,
+    MetaData,
+    bindparam,
+    inspect,
+    text,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _add_column(conn: Connection, table: str, column: str, ddl: str):
+    columns = {c["name"] for c in inspect(conn).get_columns(table)}
+    if column not in columns:
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+
+
+def _add_refferal_counters(conn: Connection):
+    _add_column(conn, "users", "refferals_count", "INTEGER NOT NULL DEFAULT 0")
+    _add_column(conn, "users", "downline_count", "INTEGER NOT NULL DEFAULT 0")
+    conn.execute(text(RECONCILE_COUNTERS_SQL))
+
+
+RECONCILE_COUNTERS_SQL = """
+WITH RECURSIVE pairs(ancestor_id, id) AS (
+    SELECT user_id, ref_id FROM refferals
+    UNION
+    SELECT pairs.ancestor_id, refferals.ref_id
+    FROM pairs JOIN refferals ON refferals.user_id = pairs.id
+)
+UPDATE users
+SET refferals_count = coalesce(direct.count, 0),
+    downline_count = coalesce(downline.count, 0)
+FROM users AS target
+LEFT JOIN (
+    SELECT user_id AS id, count(*) AS count FROM refferals GROUP BY user_id
+) AS direct ON direct.id = target.id
+LEFT JOIN (
+    SELECT ancestor_id AS id, count(*) AS count FROM pairs
+    WHERE ancestor_id != id GROUP BY ancestor_id
+) AS downline ON downline.id = target.id
+WHERE users.id = target.id
+"""
+
+
+def _add_refferal_code_key(conn: Connection):
+    conn.execute(
+        text(
+            """
+            CREATE TABLE refferal_code_new (
+                id INTEGER NOT NULL,
+                user_id INTEGER,
+                code VARCHAR,
+                code_key BLOB NOT NULL,
+                PRIMARY KEY (id),
+                FOREIGN KEY(user_id) REFERENCES users (id),
+                UNIQUE (code_key)
+            )
+            """
+        )
+    )
+    rows = conn.execute(text("SELECT id, user_id, code FROM refferal_code"))
+    values = [
+        {
+            "id": id,
+            "user_id": user_id,
+            "code": code,
+            "code_key": hashlib.sha256(code.encode()).digest()[:16],
+        }
+        for id, user_id, code in rows
+        if code
+    ]
+    if values:
+        conn.execute(
+            text(
+                "INSERT INTO refferal_code_new (id, user_id, code, code_key) "
+                "VALUES (:id, :user_id, :code, :code_key)"
+            ),
+            values,
+        )
+    conn.execute(text("DROP TABLE refferal_code"))
+    conn.execute(text("ALTER TABLE refferal_code_new RENAME TO refferal_code"))
+
+
+REFFERAL_PATHS_MAX_DEPTH = 1000
+
+# SQLite walks recursive CTEs breadth-first, so the first row inserted for
+# a pair carries its shortest depth; the depth cap bounds cyclic data.
+BUILD_REFFERAL_PATHS_SQL = f"""
+INSERT OR IGNORE INTO {{table}} (descendant_id, ancestor_id, depth)
+WITH RECURSIVE paths(ancestor_id, descendant_id, depth) AS (
+    SELECT user_id, ref_id, 1 FROM refferals
+    UNION
+    SELECT paths.ancestor_id, refferals.ref_id, paths.depth + 1
+    FROM paths JOIN refferals ON refferals.user_id = paths.descendant_id
+    WHERE paths.depth < {REFFERAL_PATHS_MAX_DEPTH}
+)
+SELECT descendant_id, ancestor_id, depth FROM paths
+WHERE ancestor_id != descendant_id
+"""
+
+
+def _add_refferal_paths(conn: Connection):
+    conn.execute(text(BUILD_REFFERAL_PATHS_SQL.format(table="refferal_paths")))
+
+
+def _add_refferal_code_expiry(conn: Connection):
+    from jose import JWTError, jwt
+
+    _add_column(conn, "refferal_code", "expires_at", "DATETIME")
+    values = []
+    for id, code in conn.execute(text("SELECT id, code FROM refferal_code")):
+        try:
+            exp = jwt.get_unverified_claims(code).get("exp")
+            expires_at = datetime.fromtimestamp(exp, timezone.utc)
+        except (JWTError, TypeError, ValueError, OverflowError):
+            continue
+        values.append(
+            {"id": id, "expires_at": expires_at.replace(tzinfo=None)}
+        )
+    if values:
+        conn.execute(
+            text(
+                "UPDATE refferal_code SET expires_at = :expires_at "
+                "WHERE id = :id"
+            ).bindparams(bindparam("expires_at", type_=DateTime())),
+            values,
+        )
+    conn.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS ix_refferal_code_expires_at "
+            "ON refferal_code (expires_at)"
+        )
+    )
+
+
+def _add_cache_invalidations(conn: Connection):
+    conn.execute(
+        text(
+            """
+            CREATE TABLE IF NOT EXISTS cache_invalidations (
+                id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+                origin VARCHAR(32) NOT NULL,
+                user_id INTEGER NOT NULL,
+                email VARCHAR(40),
+                created_at DATETIME NOT NULL
+            )
+            """
+        )
+    )
+    conn.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS ix_cache_invalidations_created_at "
+            "ON cache_invalidations (created_at)"
+        )
+    )
+
+
+def _add_user_version(conn: Connection):
+    _add_column(conn, "users", "version", "INTEGER NOT NULL DEFAULT 0")
+
+
+def _rework_indexes(conn: Connection):
+    # SQLite cannot drop an inline UNIQUE constraint, so `users` is rebuilt
+    # without the one on password hashes.
+    conn.execute(
+        text(
+            """
+            CREATE TABLE users_new (
+                id INTEGER NOT NULL,
+                username VARCHAR(50) NOT NULL,
+                password VARCHAR NOT NULL,
+                email VARCHAR(40) NOT NULL,
+                refferals_count INTEGER DEFAULT '0' NOT NULL,
+                downline_count INTEGER DEFAULT '0' NOT NULL,
+                version INTEGER DEFAULT '0' NOT NULL,
+                PRIMARY KEY (id),
+                UNIQUE (username),
+                UNIQUE (email)
+            )
+            """
+        )
+    )
+    conn.execute(
+        text(
+            "INSERT INTO users_new (id, username, password, email, "
+            "refferals_count, downline_count, version) "
+            "SELECT id, username, password, email, refferals_count, "
+            "downline_count, version FROM users"
+        )
+    )
+    conn.execute(text("DROP TABLE users"))
+    conn.execute(text("ALTER TABLE users_new RENAME TO users"))
+    conn.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS ix_refferal_code_user_id "
+            "ON refferal_code (user_id)"
+        )
+    )
+    conn.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS ix_refferals_ref_id "
+            "ON refferals (ref_id)"
+        )
+    )
+
+
+MIGRATIONS = [
+    _add_refferal_counters,
+    _add_refferal_code_key,
+    _add_refferal_paths,
+    _add_refferal_code_expiry,
+    _add_cache_invalidations,
+    _add_user_version,
+    _rework_indexes,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def get_schema_version(conn: Connection) -> int:
+    return conn.execute(text("PRAGMA user_version")).scalar() or 0
+
+
+def set_schema_version(conn: Connection, version: int):
+    conn.execute(text(f"PRAGMA user_version = {int(version)}"))
+
+
+def migrate(conn: Connection, metadata: MetaData, full: bool = False):
+    # A database stamped with the current version already has every table
+    # the metadata declares, so a boot can skip introspection and DDL.
+    # Schema changes therefore always come with a migration.
+    if not full and get_schema_version(conn) == SCHEMA_VERSION:
+        return
+    is_new = not inspect(conn).has_table("users")
+    metadata.create_all(conn)
+    if is_new:
+        set_schema_version(conn, SCHEMA_VERSION)
+        return
+    version = get_schema_version(conn)
+    for number, migration in enumerate(
+        MIGRATIONS[version:], start=version + 1
+    ):
+        logger.info("Applying migration %s: %s", number, migration.__name__)
+        migration(conn)
+        set_schema_version(conn, number)
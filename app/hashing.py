@@ -0,0 +1,289 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import (
+    Executor,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
+from typing import Any, Callable, Optional
+
+from fastapi import HTTPException
+from starlette import status
+
+from app.config import (
+    PASSWORD_HASH_EXECUTOR,
+    PASSWORD_HASH_QUEUE_SIZE,
+    PASSWORD_HASH_WORKERS,
+    PASSWORD_MIN_ROUNDS,
+    PASSWORD_ROUNDS,
+    PASSWORD_SCHEMES,
+    PASSWORD_TARGET_MS,
+)
+from app.metrics import (
+    password_duration,
+    password_rehashes,
+    password_rejections,
+    registry,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def context_settings(schemes: list[str], rounds: int = 0) -> dict[str, Any]:
+    # The first scheme hashes new passwords; the rest are only verified and
+    # get flagged by needs_update. Hashes below the configured cost are
+    # stale too, while stronger ones are kept so that workers configured a
+    # step apart do not keep rehashing each other's hashes.
+    settings: dict[str, Any] = {"schemes": schemes, "deprecated": "auto"}
+    if rounds:
+        scheme = schemes[0]
+        settings[f"{scheme}__default_rounds"] = rounds
+        settings[f"{scheme}__min_rounds"] = rounds
+    return settings
+
+
+password_settings: dict[str, Any] = {
+    "schemes": PASSWORD_SCHEMES,
+    "rounds": PASSWORD_ROUNDS,
+}
+_pwd_context = None
+
+
+def get_pwd_context():
+    # passlib is imported on first use so that it stays off the import
+    # path of processes that never hash.
+    global _pwd_context
+    if _pwd_context is None:
+        from passlib.context import CryptContext
+
+        _pwd_context = CryptContext(
+            **context_settings(
+                password_settings["schemes"], password_settings["rounds"]
+            )
+        )
+    return _pwd_context
+
+
+def configure_hashing(schemes: list[str], rounds: int = 0):
+    get_pwd_context().load(context_settings(schemes, rounds))
+    password_settings.update(schemes=schemes, rounds=rounds)
+
+
+def calibrate_rounds(scheme: str, target: float, min_rounds: int = 0) -> int:
+    from passlib.registry import get_crypt_handler
+
+    handler = get_crypt_handler(scheme)
+    if "rounds" not in handler.setting_kwds:
+        raise ValueError(f"{scheme} has no rounds to calibrate")
+
+    def measure(rounds: int):
+        hash = handler.using(rounds=rounds).hash("calibration")
+        start = time.perf_counter()
+        handler.verify("calibration", hash)
+        return time.perf_counter() - start
+
+    if handler.rounds_cost == "log2":
+        rounds = max(handler.min_rounds, min_rounds)
+        elapsed = measure(rounds)
+        while rounds < handler.max_rounds and elapsed * 2 <= target:
+            rounds += 1
+            elapsed = measure(rounds)
+        return rounds
+    rounds = handler.default_rounds
+    rounds = int(rounds * target / measure(rounds))
+    return max(handler.min_rounds, min_rounds, min(handler.max_rounds, rounds))
+
+
+def password_rounds() -> int:
+    rounds = PASSWORD_ROUNDS
+    if not rounds and PASSWORD_TARGET_MS > 0:
+        rounds = calibrate_rounds(
+            PASSWORD_SCHEMES[0], PASSWORD_TARGET_MS / 1000, PASSWORD_MIN_ROUNDS
+        )
+        logger.info(
+            "Calibrated %s to %s rounds for a %s ms verify",
+            PASSWORD_SCHEMES[0],
+            rounds,
+            PASSWORD_TARGET_MS,
+        )
+    return rounds
+
+
+def setup_password_hashing():
+    rounds = password_rounds()
+    configure_hashing(PASSWORD_SCHEMES, rounds)
+    password_pool.shutdown()
+    return rounds
+
+
+password_pool_exception = HTTPException(
+    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+    detail="Too many password operations in progress",
+    headers={"Retry-After": "1"},
+)
+
+
+def hash_password(password: str):
+    return get_pwd_context().hash(password)
+
+
+def verify_password(plain_password: str, hashed_password: str):
+    try:
+        return get_pwd_context().verify(plain_password, hashed_password)
+    except ValueError:
+        # A stored value no configured scheme recognises cannot match.
+        return False
+
+
+def verify_and_update(plain_password: str, hashed_password: str):
+    try:
+        return get_pwd_context().verify_and_update(
+            plain_password, hashed_password
+        )
+    except ValueError:
+        return False, None
+
+
+def _timed(func: Callable, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+class PasswordPool:
+    def __init__(
+        self,
+        executor: str = "thread",
+        workers: int = 1,
+        queue_size: int = 16,
+    ):
+        if executor not in ("thread", "process"):
+            raise ValueError(f"Unknown password executor: {executor}")
+        self.executor = executor
+        self.workers = workers
+        self.queue_size = queue_size
+        self.pending = 0
+        self.calls = 0
+        self.rejected = 0
+        self.wait_seconds = 0.0
+        self.run_seconds = 0.0
+        self.max_run_seconds = 0.0
+        self._executor: Optional[Executor] = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.executor == "process":
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    initializer=configure_hashing,
+                    initargs=(
+                        password_settings["schemes"],
+                        password_settings["rounds"],
+                    ),
+                )
+            else:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers,
+                    thread_name_prefix="password",
+                )
+        return self._executor
+
+    async def run(self, func: Callable, *args) -> Any:
+        if self.pending >= self.queue_size:
+            self.rejected += 1
+            password_rejections.inc()
+            raise password_pool_exception
+        self.pending += 1
+        start = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            result, run_time = await loop.run_in_executor(
+                self._get_executor(), _timed, func, *args
+            )
+        finally:
+            self.pending -= 1
+        total_time = time.perf_counter() - start
+        self.calls += 1
+        self.run_seconds += run_time
+        self.wait_seconds += max(total_time - run_time, 0.0)
+        self.max_run_seconds = max(self.max_run_seconds, run_time)
+        password_duration.observe(run_time, func.__name__, "run")
+        password_duration.observe(
+            max(total_time - run_time, 0.0), func.__name__, "wait"
+        )
+        logger.debug(
+            "%s: %.1f ms run, %.1f ms total",
+            func.__name__,
+            run_time * 1000,
+            total_time * 1000,
+        )
+        return result
+
+    async def hash(self, password: str) -> str:
+        return await self.run(hash_password, password)
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self.run(verify_password, plain_password, hashed_password)
+
+    async def verify_and_update(
+        self, plain_password: str, hashed_password: str
+    ) -> tuple[bool, Optional[str]]:
+        verified, new_hash = await self.run(
+            verify_and_update, plain_password, hashed_password
+        )
+        if new_hash is not None:
+            password_rehashes.inc()
+        return verified, new_hash
+
+    async def hash_many(self, passwords: list[str]) -> list[str]:
+        # Batch jobs keep at most `workers` hashes in flight so interactive
+        # logins queued behind them wait for one hash, not the whole batch.
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.workers)
+
+        async def _hash(password: str):
+            async with semaphore:
+                result, run_time = await loop.run_in_executor(
+                    self._get_executor(), _timed, hash_password, password
+                )
+            self.calls += 1
+            self.run_seconds += run_time
+            self.max_run_seconds = max(self.max_run_seconds, run_time)
+            password_duration.observe(run_time, "hash_password", "run")
+            return result
+
+        return await asyncio.gather(*(_hash(p) for p in passwords))
+
+    def stats(self):
+        pwd_context = get_pwd_context()
+        return {
+            "executor": self.executor,
+            "scheme": pwd_context.default_scheme(),
+            "rounds": getattr(pwd_context.handler(), "default_rounds", None),
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "pending": self.pending,
+            "calls": self.calls,
+            "rejected": self.rejected,
+            "wait_seconds": self.wait_seconds,
+            "run_seconds": self.run_seconds,
+            "max_run_seconds": self.max_run_seconds,
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+password_pool = PasswordPool(
+    executor=PASSWORD_HASH_EXECUTOR,
+    workers=PASSWORD_HASH_WORKERS,
+    queue_size=PASSWORD_HASH_QUEUE_SIZE,
+)
+registry.register_stats(
+    "password_pool",
+    password_pool.stats,
+    counters=("calls",),
+)
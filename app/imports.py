@@ -0,0 +1,192 @@
+import csv
+import json
+from collections import deque
+from typing import Any, AsyncIterable, AsyncIterator, Optional
+
+from fastapi import HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from app.config import ALGORITHM, IMPORT_CHUNK_SIZE, SECRET_KEY
+from app.hashing import password_pool
+from app.models.models import Users
+from app.models.queries import import_users_chunk
+
+
+def _decode(line: bytes) -> Optional[str]:
+    # An undecodable line becomes an invalid row instead of failing the
+    # whole import.
+    try:
+        return line.decode()
+    except UnicodeDecodeError:
+        return None
+
+
+async def iter_lines(
+    chunks: AsyncIterable[bytes],
+) -> AsyncIterator[Optional[str]]:
+    buffer = b""
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield _decode(line)
+    if buffer:
+        yield _decode(buffer)
+
+
+async def _parse_csv(
+    lines: AsyncIterable[Optional[str]],
+) -> AsyncIterator[tuple[int, Any]]:
+    # One reader sees the whole stream so quoted fields may span lines. It
+    # is only advanced once the buffered lines close every open quote, so
+    # it never runs out of input mid-record.
+    pending: deque[str] = deque()
+
+    def buffered():
+        while True:
+            yield pending.popleft()
+
+    reader = csv.reader(buffered())
+    header: Optional[list[str]] = None
+    number = start = quotes = 0
+    async for line in lines:
+        number += 1
+        if line is None:
+            yield start if pending else number, None
+            pending.clear()
+            quotes = 0
+            continue
+        if not pending:
+            if not line.strip():
+                continue
+            start = number
+        pending.append(line.removesuffix("\r") + "\n")
+        quotes += line.count('"')
+        if quotes % 2:
+            continue
+        quotes = 0
+        values = next(reader)
+        if header is None:
+            header = values
+            continue
+        yield start, dict(zip(header, values))
+    if pending:
+        yield start, None
+
+
+async def parse_rows(
+    lines: AsyncIterable[Optional[str]],
+    format: str = "ndjson",
+) -> AsyncIterator[tuple[int, Any]]:
+    if format == "csv":
+        async for row in _parse_csv(lines):
+            yield row
+        return
+    number = 0
+    async for line in lines:
+        number += 1
+        if line is None:
+            yield number, None
+            continue
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield number, json.loads(line)
+        except ValueError:
+            yield number, None
+
+
+def _validate_row(row: Any, seen: set[str]) -> Optional[str]:
+    if not isinstance(row, dict) or not all(
+        isinstance(row.get(key) or "", str)
+        for key in ("username", "email", "password", "refferal_code")
+    ):
+        return "Invalid row"
+    try:
+        Users(
+            username=row.get("username") or "",
+            password=row.get("password") or "",
+            email=row.get("email") or "",
+        )
+    except HTTPException as exc:
+        return exc.detail
+    if not row.get("password"):
+        return "Password can't be empty"
+    if "u:" + row["username"] in seen:
+        return "Duplicate username in import"
+    if "e:" + row["email"] in seen:
+        return "Duplicate email in import"
+    if row.get("refferal_code"):
+        from jose import JWTError, jwt
+
+        try:
+            jwt.decode(
+                row["refferal_code"], SECRET_KEY, algorithms=[ALGORITHM]
+            )
+        except JWTError:
+            return "Invalid refferal_code"
+    return None
+
+
+async def _import_chunk(
+    chunk: list[tuple[int, dict[str, Any]]],
+    async_session: async_sessionmaker[AsyncSession],
+):
+    passwords = await password_pool.hash_many(
+        [row["password"] for _, row in chunk]
+    )
+    rows = [
+        {
+            "username": row["username"],
+            "email": row["email"],
+            "password": password,
+            "refferal_code": row.get("refferal_code") or None,
+        }
+        for (_, row), password in zip(chunk, passwords)
+    ]
+    errors = await import_users_chunk(rows, async_session)
+    return [
+        {"line": number, "username": row["username"], "error": error}
+        for (number, row), error in zip(chunk, errors)
+        if error is not None
+    ]
+
+
+async def import_users(
+    rows: AsyncIterable[tuple[int, Any]],
+    async_session: async_sessionmaker[AsyncSession],
+    chunk_size: int = IMPORT_CHUNK_SIZE,
+):
+    total = 0
+    failed: list[dict[str, Any]] = []
+    seen: set[str] = set()
+    chunk: list[tuple[int, dict[str, Any]]] = []
+    async for number, row in rows:
+        total += 1
+        error = _validate_row(row, seen)
+        if error is not None:
+            failed.append(
+                {
+                    "line": number,
+                    "username": (
+                        row.get("username") if isinstance(row, dict) else None
+                    ),
+                    "error": error,
+                }
+            )
+            continue
+        seen.add("u:" + row["username"])
+        seen.add("e:" + row["email"])
+        chunk.append((number, row))
+        if len(chunk) >= chunk_size:
+            failed.extend(await _import_chunk(chunk, async_session))
+            chunk = []
+    if chunk:
+        failed.extend(await _import_chunk(chunk, async_session))
+    failed.sort(key=lambda failure: failure["line"])
+    return {
+        "total": total,
+        "imported": total - len(failed),
+        "failed": failed,
+    }
@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import os
+import secrets
+import time
+from datetime import timedelta
+from typing import Callable, Optional
+
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from app.batching import WriteBatcher
+from app.database.database import read_session
+from app.models.models import cache_invalidations, utcnow
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[int, Optional[str]], None]
+
+
+class InvalidationBus:
+    def __init__(
+        self,
+        handler: Handler,
+        enabled: bool = False,
+        interval: float = 0.02,
+        retention: float = 300,
+    ):
+        self.handler = handler
+        self.enabled = enabled
+        self.interval = interval
+        self.retention = retention
+        self.origin = f"{os.getpid()}-{secrets.token_hex(4)}"
+        self.last_id = 0
+        self.published = 0
+        self.received = 0
+        self.errors = 0
+        self._async_session: Optional[async_sessionmaker[AsyncSession]] = None
+        self._task: Optional[asyncio.Task] = None
+        # Invalidations raised concurrently share one write transaction.
+        self._batcher = WriteBatcher(self._flush, max_items=500, max_delay=0)
+
+    async def _flush(
+        self,
+        async_session: async_sessionmaker[AsyncSession],
+        items: list[tuple[int, Optional[str]]],
+    ):
+        created_at = utcnow()
+        async with async_session() as session:
+            async with session.begin():
+                await session.execute(
+                    insert(cache_invalidations),
+                    [
+                        {
+                            "origin": self.origin,
+                            "user_id": user_id,
+                            "email": email,
+                            "created_at": created_at,
+                        }
+                        for user_id, email in items
+                    ],
+                )
+        self.published += len(items)
+        return [None] * len(items)
+
+    async def publish(self, user_id: int, email: Optional[str] = None):
+        if self._async_session is None:
+            return
+        try:
+            await self._batcher.submit(self._async_session, (user_id, email))
+        except Exception as exc:
+            self.errors += 1
+            logger.warning("Publishing an invalidation failed: %s", exc)
+
+    async def poll(self) -> int:
+        async with read_session(self._async_session)() as session:
+            res = await session.execute(
+                select(
+                    cache_invalidations.c.id,
+                    cache_invalidations.c.origin,
+                    cache_invalidations.c.user_id,
+                    cache_invalidations.c.email,
+                )
+                .where(cache_invalidations.c.id > self.last_id)
+                .order_by(cache_invalidations.c.id)
+            )
+            rows = res.all()
+        for id, origin, user_id, email in rows:
+            self.last_id = id
+            if origin != self.origin:
+                self.handler(user_id, email)
+                self.received += 1
+        return len(rows)
+
+    async def prune(self):
+        async with self._async_session() as session:
+            async with session.begin():
+                await session.execute(
+                    delete(cache_invalidations).where(
+                        cache_invalidations.c.created_at
+                        < utcnow() - timedelta(seconds=self.retention)
+                    )
+                )
+
+    async def _run(self):
+        pruned = time.monotonic()
+        while True:
+            try:
+                await self.poll()
+                if time.monotonic() - pruned >= self.retention:
+                    await self.prune()
+                    pruned = time.monotonic()
+            except Exception as exc:
+                self.errors += 1
+                logger.warning("Invalidation poll failed: %s", exc)
+            await asyncio.sleep(self.interval)
+
+    async def start(self, async_session: async_sessionmaker[AsyncSession]):
+        if not self.enabled or self._async_session is not None:
+            return
+        # Entries written before this worker started cannot be in its
+        # caches, so it only follows the log from here on.
+        async with read_session(async_session)() as session:
+            res = await session.execute(
+                select(func.max(cache_invalidations.c.id))
+            )
+            self.last_id = res.scalar() or 0
+        self._async_session = async_session
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stats(self):
+        return {
+            "published": self.published,
+            "received": self.received,
+            "errors": self.errors,
+            "last_id": self.last_id,
+        }
+
+    async def close(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+        self._async_session = None
+        await self._batcher.close()
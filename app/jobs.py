@@ -0,0 +1,74 @@
+import argparse
+import asyncio
+import json
+
+from app.config import IMPORT_CHUNK_SIZE
+from app.database.database import (
+    Base,
+    async_session,
+    dispose_sessionmaker,
+    engine,
+)
+from app.imports import import_users, iter_lines, parse_rows
+from app.models.queries import reconcile_refferal_counters, startapp
+
+
+async def reconcile_counters(fix: bool):
+    await startapp(engine, Base)
+    report = await reconcile_refferal_counters(async_session, fix=fix)
+    await dispose_sessionmaker(async_session)
+    print(json.dumps(report))
+
+
+async def _read_chunks(path: str, size: int = 1 << 16):
+    with open(path, "rb") as file:
+        while chunk := file.read(size):
+            yield chunk
+
+
+async def import_accounts(path: str, format: str, chunk_size: int):
+    await startapp(engine, Base)
+    report = await import_users(
+        parse_rows(iter_lines(_read_chunks(path)), format),
+        async_session,
+        chunk_size,
+    )
+    await dispose_sessionmaker(async_session)
+    print(json.dumps(report))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.jobs")
+    commands = parser.add_subparsers(dest="command", required=True)
+    reconcile = commands.add_parser(
+        "reconcile-counters",
+        help="Recompute referral counters and report drift",
+    )
+    reconcile.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only report drift, don't fix it",
+    )
+    accounts = commands.add_parser(
+        "import-users",
+        help="Bulk import users from an NDJSON or CSV file",
+    )
+    accounts.add_argument("path")
+    accounts.add_argument(
+        "--format",
+        choices=["ndjson", "csv"],
+        help="Defaults to csv for *.csv files and ndjson otherwise",
+    )
+    accounts.add_argument("--chunk-size", type=int, default=IMPORT_CHUNK_SIZE)
+    args = parser.parse_args(argv)
+    if args.command == "reconcile-counters":
+        asyncio.run(reconcile_counters(fix=not args.dry_run))
+    elif args.command == "import-users":
+        format = args.format or (
+            "csv" if args.path.endswith(".csv") else "ndjson"
+        )
+        asyncio.run(import_accounts(args.path, format, args.chunk_size))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,47 @@
+import asyncio
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
 
-from app.database.database import Base, engine
-from app.models.queries import startapp
-from app.routers import account, refferal
+from app.database.database import (
+    Base,
+    async_session,
+    dispose_sessionmaker,
+    engine,
+)
+from app.hashing import password_pool, setup_password_hashing
+from app.metrics import MetricsMiddleware
+from app.profiling import ProfilerMiddleware
+from app.models.queries import (
+    invalidation_bus,
+    refferal_code_cache,
+    refferal_code_sweeper,
+    registration_batcher,
+    startapp,
+)
+from app.routers import account, metrics, refferal, stats
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await startapp(engine, Base)
+    await asyncio.to_thread(setup_password_hashing)
+    refferal_code_sweeper.start(async_session)
+    await invalidation_bus.start(async_session)
     yield
-    await engine.dispose()
+    await invalidation_bus.close()
+    await refferal_code_sweeper.close()
+    password_pool.shutdown()
+    await registration_batcher.close()
+    await refferal_code_cache.close()
+    await dispose_sessionmaker(async_session)
 
 
 app = FastAPI(lifespan=lifespan)
+app.add_middleware(ProfilerMiddleware)
+app.add_middleware(MetricsMiddleware)
 
 app.include_router(account.router)
 app.include_router(refferal.router)
+app.include_router(stats.router)
+app.include_router(metrics.router)
@@ -0,0 +1,299 @@
+import bisect
+import time
+from typing import Any, Callable, Iterable, Optional
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+Sample = tuple[str, dict[str, Any], float]
+Family = tuple[str, str, str, list[Sample]]
+
+
+def _escape(value: Any):
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\n", "\\n")
+        .replace('"', '\\"')
+    )
+
+
+def _format_labels(labels: dict[str, Any]):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+    return "{" + pairs + "}"
+
+
+def _format_value(value: float):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# All observations happen on the event loop thread, so plain dict and list
+# updates are enough; nothing here takes a lock.
+class Counter:
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0)
+
+    def samples(self) -> list[Sample]:
+        return [
+            (self.name, dict(zip(self.labelnames, labels)), value)
+            for labels, value in self._values.items()
+        ]
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames=(),
+        buckets=DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # Per label set: one slot per bucket, +Inf, then sum and count.
+        self._series: dict[tuple, list[float]] = {}
+
+    def observe(self, value: float, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * (len(self.buckets) + 3)
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def count(self, *labels) -> int:
+        series = self._series.get(labels)
+        return int(series[-1]) if series is not None else 0
+
+    def samples(self) -> list[Sample]:
+        samples: list[Sample] = []
+        for labels, series in self._series.items():
+            names = dict(zip(self.labelnames, labels))
+            cumulative = 0
+            for bound, count in zip(
+                (*self.buckets, float("inf")), series[:-2]
+            ):
+                cumulative += count
+                samples.append(
+                    (
+                        f"{self.name}_bucket",
+                        {**names, "le": _format_value(bound)},
+                        cumulative,
+                    )
+                )
+            samples.append((f"{self.name}_sum", names, series[-2]))
+            samples.append((f"{self.name}_count", names, series[-1]))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: list[Counter | Histogram] = []
+        self._collectors: list[Callable[[], Iterable[Family]]] = []
+
+    def counter(self, name: str, help: str, labelnames=()) -> Counter:
+        metric = Counter(name, help, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labelnames=(),
+        buckets=DEFAULT_BUCKETS,
+    ) -> Histogram:
+        metric = Histogram(name, help, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, func: Callable[[], Iterable[Family]]):
+        self._collectors.append(func)
+        return func
+
+    def register_stats(
+        self,
+        prefix: str,
+        stats: Callable[[], dict[str, Any]],
+        labels: Optional[dict[str, Any]] = None,
+        counters: Iterable[str] = (),
+    ):
+        counters = set(counters)
+
+        def collect():
+            for key, value in stats().items():
+                if isinstance(value, bool) or not isinstance(
+                    value, (int, float)
+                ):
+                    continue
+                if key in counters:
+                    name, type = f"{prefix}_{key}_total", "counter"
+                else:
+                    name, type = f"{prefix}_{key}", "gauge"
+                yield name, type, f"{prefix} {key}", [
+                    (name, labels or {}, value)
+                ]
+
+        self._collectors.append(collect)
+
+    def render(self) -> str:
+        families: dict[str, tuple[str, str, list[Sample]]] = {}
+        for metric in self._metrics:
+            families[metric.name] = (metric.type, metric.help, [])
+            families[metric.name][2].extend(metric.samples())
+        for collect in self._collectors:
+            for name, type, help, samples in collect():
+                families.setdefault(name, (type, help, []))[2].extend(samples)
+        lines = []
+        for name, (type, help, samples) in families.items():
+            lines.append(f"# HELP {name} {_escape(help)}")
+            lines.append(f"# TYPE {name} {type}")
+            for sample_name, labels, value in samples:
+                lines.append(
+                    f"{sample_name}{_format_labels(labels)} "
+                    f"{_format_value(value)}"
+                )
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_request_duration = registry.histogram(
+    "http_request_duration_seconds",
+    "HTTP request latency by route",
+    ("method", "route", "status"),
+)
+db_statement_duration = registry.histogram(
+    "db_statement_duration_seconds",
+    "Database statement execution time",
+    ("engine", "operation"),
+)
+db_statement_errors = registry.counter(
+    "db_statement_errors_total",
+    "Database statements that raised",
+    ("engine",),
+)
+db_pool_wait = registry.histogram(
+    "db_pool_checkout_wait_seconds",
+    "Time spent waiting for a pooled database connection",
+    ("engine",),
+)
+password_duration = registry.histogram(
+    "password_operation_seconds",
+    "bcrypt hash/verify time, split into queue wait and run",
+    ("operation", "phase"),
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 2.5, 5.0),
+)
+admission_rejections = registry.counter(
+    "admission_rejections_total",
+    "Requests shed by admission control",
+    ("endpoint", "reason"),
+)
+password_rehashes = registry.counter(
+    "password_rehashes_total",
+    "Stale password hashes upgraded on login",
+)
+password_rejections = registry.counter(
+    "password_rejections_total",
+    "Password operations rejected because the queue was full",
+)
+
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            http_request_duration.observe(
+                time.perf_counter() - start,
+                scope["method"],
+                route.path if route is not None else "<unmatched>",
+                status,
+            )
+
+
+_operations: dict[str, str] = {}
+
+
+def _operation(statement: str):
+    operation = _operations.get(statement)
+    if operation is None:
+        words = statement.split(None, 1)
+        operation = words[0].upper() if words else ""
+        if len(_operations) < 10_000:
+            _operations[statement] = operation
+    return operation
+
+
+def instrument_engine(engine: AsyncEngine, name: str):
+    sync_engine = engine.sync_engine
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before_execute(conn, cursor, statement, params, context, many):
+        conn.info["metrics_start"] = time.perf_counter()
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after_execute(conn, cursor, statement, params, context, many):
+        db_statement_duration.observe(
+            time.perf_counter() - conn.info.pop("metrics_start"),
+            name,
+            _operation(statement),
+        )
+
+    @event.listens_for(sync_engine, "handle_error")
+    def _handle_error(context):
+        if context.connection is not None:
+            context.connection.info.pop("metrics_start", None)
+        db_statement_errors.inc(name)
@@ -1,19 +1,37 @@
+from datetime import datetime, timezone
+import hashlib
 import re
+from typing import Optional
 
 from fastapi import HTTPException
-from sqlalchemy import Column, ForeignKey, Integer, String, Table
+from sqlalchemy import (
+    Column,
+    DateTime,
+    ForeignKey,
+    Index,
+    Integer,
+    LargeBinary,
+    String,
+    Table,
+)
 from sqlalchemy.orm import relationship, validates
 from starlette import status
 
 from app.database.database import Base
 
 
+EMAIL_PATTERN = re.compile(
+    r"([A-Za-z0-9]+[.-_])*[A-Za-z0-9]+@[A-Za-z0-9-]+(\.[A-Z|a-z]{2,})+"
+)
+
+
+def is_valid_email(email: str):
+    return EMAIL_PATTERN.fullmatch(email) is not None
+
+
 def check_email(email: str):
-    pattern = re.compile(
-        r"([A-Za-z0-9]+[.-_])*[A-Za-z0-9]+@[A-Za-z0-9-]+(\.[A-Z|a-z]{2,})+"
-    )
     try:
-        assert re.fullmatch(pattern, email)
+        assert is_valid_email(email)
         return email
     except AssertionError:
         email_validation_exception = HTTPException(
@@ -23,13 +41,42 @@ def check_email(email: str):
         raise email_validation_exception
 
 
+def refferal_code_key(code: str) -> bytes:
+    return hashlib.sha256(code.encode()).digest()[:16]
+
+
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def refferal_code_expiry(code: str) -> Optional[datetime]:
+    from jose import JWTError, jwt
+
+    try:
+        exp = jwt.get_unverified_claims(code).get("exp")
+        if exp is None:
+            return None
+        return datetime.fromtimestamp(exp, timezone.utc).replace(tzinfo=None)
+    except (JWTError, TypeError, ValueError, OverflowError):
+        return None
+
+
 class Users(Base):
     __tablename__ = "users"
 
     id = Column(Integer, primary_key=True)
     username = Column(String(50), nullable=False, unique=True)
-    password = Column(String(), nullable=False, unique=True)
+    password = Column(String(), nullable=False)
     email = Column(String(40), nullable=False, unique=True)
+    refferals_count = Column(
+        Integer, nullable=False, default=0, server_default="0"
+    )
+    downline_count = Column(
+        Integer, nullable=False, default=0, server_default="0"
+    )
+    # Bumped whenever the user's referrals or referral code change; read
+    # endpoints derive their ETag from it.
+    version = Column(Integer, nullable=False, default=0, server_default="0")
     ref_users = relationship(
         "Users",
         secondary="refferals",
@@ -68,8 +115,22 @@ class RefferalCode(Base):
     __tablename__ = "refferal_code"
 
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey("users.id"))
-    code = Column(String(), unique=True)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    code = Column(String())
+    code_key = Column(LargeBinary(16), nullable=False, unique=True)
+    # Naive UTC copy of the code's `exp` claim, so expired codes can be
+    # found through an index instead of decoding every token.
+    expires_at = Column(DateTime, index=True)
+
+    @validates("code")
+    def validate_code(self, key, value):
+        self.code_key = refferal_code_key(value)
+        self.expires_at = refferal_code_expiry(value)
+        return value
+
+    @property
+    def expired(self):
+        return self.expires_at is not None and self.expires_at <= utcnow()
 
 
 refferals = Table(
@@ -87,4 +148,41 @@ refferals = Table(
         ForeignKey(Users.id),
         primary_key=True,
     ),
+    Index("ix_refferals_ref_id", "ref_id"),
+)
+
+
+# Closure of `refferals`: one row per (descendant, ancestor) pair with the
+# number of hops between them, maintained alongside every new link.
+refferal_paths = Table(
+    "refferal_paths",
+    Base.metadata,
+    Column(
+        "descendant_id",
+        Integer,
+        ForeignKey(Users.id),
+        primary_key=True,
+    ),
+    Column(
+        "ancestor_id",
+        Integer,
+        ForeignKey(Users.id),
+        primary_key=True,
+    ),
+    Column("depth", Integer, nullable=False),
+    Index("ix_refferal_paths_ancestor_id_depth", "ancestor_id", "depth"),
+)
+
+
+# Change log that lets every worker process evict its in-process cache
+# entries after a write made by another worker.
+cache_invalidations = Table(
+    "cache_invalidations",
+    Base.metadata,
+    Column("id", Integer, primary_key=True),
+    Column("origin", String(32), nullable=False),
+    Column("user_id", Integer, nullable=False),
+    Column("email", String(40)),
+    Column("created_at", DateTime, nullable=False, index=True),
+    sqlite_autoincrement=True,
 )
@@ -1,19 +1,91 @@
-import time
-from typing import Any, Optional
+import asyncio
+from enum import Enum
+from typing import Any, NamedTuple, Optional
 
 from fastapi import HTTPException
-from fastapi_cache import FastAPICache
-from fastapi_cache.backends.redis import RedisBackend
-from fastapi_cache.decorator import cache
-from jose import JWTError, jwt
-from redis import asyncio as aioredis
+from sqlalchemy import (
+    String,
+    cast,
+    delete,
+    func,
+    insert,
+    literal,
+    or_,
+    text,
+    update,
+)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 from sqlalchemy.future import select
 from sqlalchemy.orm import noload
 from starlette import status
 
-from app.config import ALGORITHM, SECRET_KEY
-from app.models.models import RefferalCode, Users, refferals
+from app.config import (
+    ALGORITHM,
+    INVALIDATION_BUS,
+    INVALIDATION_POLL_INTERVAL,
+    INVALIDATION_RETENTION,
+    REFFERAL_CODE_SWEEP_CHUNK,
+    REFFERAL_CODE_SWEEP_INTERVAL,
+    REFFERALS_STREAM_CHUNK,
+    REGISTRATION_BATCH_DELAY,
+    REGISTRATION_BATCH_SIZE,
+    REGISTRATION_BATCHING,
+    SCHEMA_CHECK,
+    SECRET_KEY,
+)
+from app.batching import WriteBatcher
+from app.cache import STATS_COUNTERS, build_cache
+from app.database.database import read_session
+from app.database.migrations import BUILD_REFFERAL_PATHS_SQL, migrate
+from app.invalidation import InvalidationBus
+from app.models.models import (
+    RefferalCode,
+    Users,
+    refferal_code_key,
+    refferal_paths,
+    refferals,
+    utcnow,
+)
+from app.metrics import registry
+from app.models.schemas import ActiveUser
+from app.principals import principal_cache
+from app.sweeper import Sweeper
+
+refferal_code_cache = build_cache("refferal-code")
+registry.register_stats(
+    "cache",
+    refferal_code_cache.stats,
+    {"cache": "refferal_code"},
+    counters=STATS_COUNTERS,
+)
+
+
+def _evict_local(id: int, email: Optional[str] = None):
+    principal_cache.invalidate(id)
+    if email is not None:
+        refferal_code_cache.local.delete(email)
+
+
+invalidation_bus = InvalidationBus(
+    _evict_local,
+    enabled=INVALIDATION_BUS,
+    interval=INVALIDATION_POLL_INTERVAL,
+    retention=INVALIDATION_RETENTION,
+)
+registry.register_stats(
+    "invalidation_bus",
+    invalidation_bus.stats,
+    counters=("published", "received", "errors"),
+)
+
+
+async def invalidate_user(id: int, email: Optional[str] = None):
+    principal_cache.invalidate(id)
+    if email is not None:
+        await refferal_code_cache.delete(email)
+    await invalidation_bus.publish(id, email)
 
 
 def raise_refferal_exception():
@@ -28,22 +100,29 @@ async def is_ref_valid(
     ref_code: str,
     async_session: async_sessionmaker[AsyncSession],
 ):
+    from jose import JWTError, jwt
+
     try:
-        payload = jwt.decode(ref_code, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("email", "")
-        user = await get_user_by_email(email, async_session)
-        if user and user.refferal_code and user.refferal_code.code == ref_code:
-            return user
-        raise_refferal_exception()
+        jwt.decode(ref_code, SECRET_KEY, algorithms=[ALGORITHM])
     except JWTError:
         raise_refferal_exception()
+    async with read_session(async_session)() as session:
+        res = await session.execute(
+            select(Users.id, Users.username, Users.email)
+            .join(RefferalCode, RefferalCode.user_id == Users.id)
+            .where(RefferalCode.code_key == refferal_code_key(ref_code))
+        )
+        user = res.one_or_none()
+    if user is None:
+        raise_refferal_exception()
+    return user
 
 
 async def get_user_by_username(
     username: str,
     async_session: async_sessionmaker[AsyncSession],
 ):
-    async with async_session() as session:
+    async with read_session(async_session)() as session:
         res = await session.execute(
             select(Users)
             .filter(Users.username.in_([username]))
@@ -54,6 +133,22 @@ async def get_user_by_username(
         return user
 
 
+async def update_user_password(
+    id: int,
+    old_hash: str,
+    new_hash: str,
+    async_session: async_sessionmaker[AsyncSession],
+):
+    async with async_session() as session:
+        async with session.begin():
+            res = await session.execute(
+                update(Users)
+                .where(Users.id == id, Users.password == old_hash)
+                .values(password=new_hash)
+            )
+    return res.rowcount == 1
+
+
 async def register_a_user(
     user_data: dict[str, Any],
     async_session: async_sessionmaker[AsyncSession],
@@ -67,28 +162,167 @@ async def register_a_user(
         head_user = await is_ref_valid(
             user_data["refferal_code"], async_session
         )
-        if head_user:
-            return await add_user_and_ref(
-                head_user=head_user,
-                new_user=new_user,
-                async_session=async_session,
+        if REGISTRATION_BATCHING:
+            return await registration_batcher.submit(
+                async_session, (new_user, head_user.id)
             )
-        return
+        return await add_user_and_ref(
+            head_user=head_user,
+            new_user=new_user,
+            async_session=async_session,
+        )
+    if REGISTRATION_BATCHING:
+        return await registration_batcher.submit(
+            async_session, (new_user, None)
+        )
     return await add_user(new_user, async_session)
 
 
+class RegistrationStatus(str, Enum):
+    created = "created"
+    username_taken = "username_taken"
+    email_taken = "email_taken"
+    conflict = "conflict"
+
+
+class RegistrationResult(NamedTuple):
+    status: RegistrationStatus
+    id: Optional[int] = None
+
+
+async def _conflict_status(
+    user: Users,
+    async_session: async_sessionmaker[AsyncSession],
+):
+    async with read_session(async_session)() as session:
+        res = await session.execute(
+            select(Users.username, Users.email).where(
+                or_(Users.username == user.username, Users.email == user.email)
+            )
+        )
+        taken = res.all()
+    if any(username == user.username for username, _ in taken):
+        return RegistrationStatus.username_taken
+    if any(email == user.email for _, email in taken):
+        return RegistrationStatus.email_taken
+    return RegistrationStatus.conflict
+
+
+async def _insert_user(session: AsyncSession, user: Users) -> int:
+    res = await session.execute(
+        insert(Users)
+        .values(
+            username=user.username,
+            password=user.password,
+            email=user.email,
+        )
+        .returning(Users.id)
+    )
+    return res.scalar_one()
+
+
 async def add_user(
-    user,
+    user: Users,
     async_session: async_sessionmaker[AsyncSession],
 ):
     try:
         async with async_session() as session:
             async with session.begin():
-                session.add(user)
-                await session.commit()
-        return user
-    except Exception:
+                id = await _insert_user(session, user)
+    except IntegrityError:
+        status = await _conflict_status(user, async_session)
+        return RegistrationResult(status)
+    return RegistrationResult(RegistrationStatus.created, id)
+
+
+def _bump_version(*where):
+    return update(Users).where(*where).values(version=Users.version + 1)
+
+
+def _ancestors(id: int):
+    return select(refferal_paths.c.ancestor_id).where(
+        refferal_paths.c.descendant_id == id
+    )
+
+
+async def _link_refferals(
+    session: AsyncSession,
+    head_id: int,
+    ref_ids: list[int],
+):
+    if not ref_ids:
         return
+    res = await session.execute(
+        select(refferal_paths.c.ancestor_id, refferal_paths.c.depth).where(
+            refferal_paths.c.descendant_id == head_id
+        )
+    )
+    upline = [(head_id, 0), *res.all()]
+    await session.execute(
+        refferals.insert(),
+        [{"user_id": head_id, "ref_id": ref_id} for ref_id in ref_ids],
+    )
+    await session.execute(
+        refferal_paths.insert(),
+        [
+            {
+                "descendant_id": ref_id,
+                "ancestor_id": ancestor_id,
+                "depth": depth + 1,
+            }
+            for ref_id in ref_ids
+            for ancestor_id, depth in upline
+        ],
+    )
+    await session.execute(
+        update(Users)
+        .where(Users.id == head_id)
+        .values(
+            refferals_count=Users.refferals_count + len(ref_ids),
+            version=Users.version + 1,
+        )
+    )
+    await session.execute(
+        update(Users)
+        .where(Users.id.in_([ancestor_id for ancestor_id, _ in upline]))
+        .values(downline_count=Users.downline_count + len(ref_ids))
+    )
+
+
+async def _unlink_refferals(session: AsyncSession, head_id: int):
+    res = await session.execute(
+        select(Users.downline_count).where(Users.id == head_id)
+    )
+    detached = res.scalar() or 0
+    await session.execute(
+        refferals.delete().where(refferals.c.user_id == head_id)
+    )
+    # The detached subtree keeps its internal paths but loses every path
+    # through the head.
+    await session.execute(
+        refferal_paths.delete().where(
+            refferal_paths.c.descendant_id.in_(
+                select(refferal_paths.c.descendant_id).where(
+                    refferal_paths.c.ancestor_id == head_id
+                )
+            ),
+            or_(
+                refferal_paths.c.ancestor_id == head_id,
+                refferal_paths.c.ancestor_id.in_(_ancestors(head_id)),
+            ),
+        )
+    )
+    await session.execute(
+        update(Users)
+        .where(Users.id == head_id)
+        .values(refferals_count=0, downline_count=0, version=Users.version + 1)
+    )
+    if detached:
+        await session.execute(
+            update(Users)
+            .where(Users.id.in_(_ancestors(head_id)), Users.id != head_id)
+            .values(downline_count=Users.downline_count - detached)
+        )
 
 
 async def add_user_and_ref(
@@ -99,56 +333,191 @@ async def add_user_and_ref(
     try:
         async with async_session() as session:
             async with session.begin():
-                session.add(new_user)
-                await session.commit()
-            statement = refferals.insert().values(
-                user_id=head_user.id, ref_id=new_user.id
+                id = await _insert_user(session, new_user)
+                await _link_refferals(session, head_user.id, [id])
+    except IntegrityError:
+        status = await _conflict_status(new_user, async_session)
+        return RegistrationResult(status)
+    await invalidate_user(head_user.id)
+    return RegistrationResult(RegistrationStatus.created, id)
+
+
+async def add_users_batch(
+    async_session: async_sessionmaker[AsyncSession],
+    registrations: list[tuple[Users, Optional[int]]],
+):
+    heads: dict[int, list[int]] = {}
+    async with async_session() as session:
+        async with session.begin():
+            ids = await _insert_users(
+                session,
+                [
+                    {
+                        "username": user.username,
+                        "password": user.password,
+                        "email": user.email,
+                    }
+                    for user, _ in registrations
+                ],
             )
-            await session.execute(statement)
-            await session.commit()
-        return new_user
-    except Exception:
-        return
+            for (_, head_id), id in zip(registrations, ids):
+                if id is not None and head_id is not None:
+                    heads.setdefault(head_id, []).append(id)
+            for head_id, ref_ids in heads.items():
+                await _link_refferals(session, head_id, ref_ids)
+    for head_id in heads:
+        await invalidate_user(head_id)
+    results = []
+    for (user, _), id in zip(registrations, ids):
+        if id is None:
+            status = await _conflict_status(user, async_session)
+            results.append(RegistrationResult(status))
+        else:
+            results.append(RegistrationResult(RegistrationStatus.created, id))
+    return results
 
 
-async def startapp(engine, Base):
-    redis = aioredis.from_url(
-        "redis://localhost", encoding="utf8", decode_responses=True
+registration_batcher = WriteBatcher(
+    add_users_batch,
+    max_items=REGISTRATION_BATCH_SIZE,
+    max_delay=REGISTRATION_BATCH_DELAY,
+)
+registry.register_stats(
+    "registration_batcher",
+    registration_batcher.stats,
+    counters=("batches", "items", "errors"),
+)
+
+
+async def _insert_users(session: AsyncSession, rows: list[dict[str, Any]]):
+    # Conflicting rows are skipped rather than retried under savepoints: a
+    # SAVEPOINT opening the transaction would commit on RELEASE, before the
+    # caller links the referrals.
+    if not rows:
+        return []
+    statement = (
+        sqlite_insert(Users)
+        .on_conflict_do_nothing()
+        .returning(Users.id, Users.username, Users.email)
+    )
+    res = await session.execute(
+        statement,
+        [
+            {
+                "username": row["username"],
+                "password": row["password"],
+                "email": row["email"],
+            }
+            for row in rows
+        ],
     )
-    FastAPICache.init(RedisBackend(redis), prefix="fastapi-cache")
+    inserted = {(username, email): id for id, username, email in res.all()}
+    return [
+        inserted.pop((row["username"], row["email"]), None) for row in rows
+    ]
+
+
+async def import_users_chunk(
+    rows: list[dict[str, Any]],
+    async_session: async_sessionmaker[AsyncSession],
+):
+    errors: list[Optional[str]] = [None] * len(rows)
+    codes = {row["refferal_code"] for row in rows if row["refferal_code"]}
+    heads: dict[int, list[int]] = {}
+    async with async_session() as session:
+        async with session.begin():
+            res = await session.execute(
+                select(Users.username, Users.email).where(
+                    or_(
+                        Users.username.in_([row["username"] for row in rows]),
+                        Users.email.in_([row["email"] for row in rows]),
+                    )
+                )
+            )
+            taken = res.all()
+            taken_usernames = {username for username, _ in taken}
+            taken_emails = {email for _, email in taken}
+            head_ids: dict[str, int] = {}
+            if codes:
+                keys = {refferal_code_key(code): code for code in codes}
+                res = await session.execute(
+                    select(RefferalCode.code_key, RefferalCode.user_id).where(
+                        RefferalCode.code_key.in_(keys)
+                    )
+                )
+                head_ids = {keys[key]: user_id for key, user_id in res.all()}
+
+            pending = []
+            for index, row in enumerate(rows):
+                if row["username"] in taken_usernames:
+                    errors[index] = "Username is already taken"
+                elif row["email"] in taken_emails:
+                    errors[index] = "Email is already taken"
+                elif row["refferal_code"] and (
+                    row["refferal_code"] not in head_ids
+                ):
+                    errors[index] = "Invalid refferal_code"
+                else:
+                    pending.append(index)
+
+            ids = await _insert_users(session, [rows[i] for i in pending])
+            for index, id in zip(pending, ids):
+                if id is None:
+                    errors[index] = "Username or email is already taken"
+                elif rows[index]["refferal_code"]:
+                    head_id = head_ids[rows[index]["refferal_code"]]
+                    heads.setdefault(head_id, []).append(id)
+            for head_id, ref_ids in heads.items():
+                await _link_refferals(session, head_id, ref_ids)
+    for head_id in heads:
+        await invalidate_user(head_id)
+    return errors
+
+
+async def startapp(engine, Base):
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(
+            migrate, Base.metadata, full=SCHEMA_CHECK == "full"
+        )
 
 
 async def add_refferal_code_to_user(
-    user_id: int,
+    user: ActiveUser,
     code: str,
     async_session: async_sessionmaker[AsyncSession],
 ):
     try:
         async with async_session() as session:
             async with session.begin():
-                ref_code = RefferalCode(code=code, user_id=user_id)
+                await session.execute(
+                    delete(RefferalCode).where(
+                        RefferalCode.user_id == user.id,
+                        RefferalCode.expires_at <= utcnow(),
+                    )
+                )
+                ref_code = RefferalCode(code=code, user_id=user.id)
                 session.add(ref_code)
+                await session.execute(_bump_version(Users.id == user.id))
                 await session.commit()
+        await invalidate_user(user.id, user.email)
         return True
     except Exception:
         return
 
 
 async def delete_ref_code(
-    ref_code: RefferalCode,
+    user: ActiveUser,
     async_session: async_sessionmaker[AsyncSession],
 ):
     try:
         async with async_session() as session:
             async with session.begin():
-                await session.delete(ref_code)
-                statement = refferals.delete().where(
-                    refferals.c.user_id == ref_code.user_id,
+                await session.execute(
+                    delete(RefferalCode).where(RefferalCode.user_id == user.id)
                 )
-                await session.execute(statement)
+                await _unlink_refferals(session, user.id)
                 await session.commit()
+        await invalidate_user(user.id, user.email)
         return True
     except Exception:
         return
@@ -158,7 +527,7 @@ async def get_user_by_email(
     email: str,
     async_session: async_sessionmaker[AsyncSession],
 ):
-    async with async_session() as session:
+    async with read_session(async_session)() as session:
         res = await session.execute(
             select(Users)
             .filter(Users.email.in_([email]))
@@ -170,30 +539,438 @@ async def get_user_by_email(
             return user
 
 
-@cache(expire=60)
 async def get_refferal_code(
     email: str,
     async_session: async_sessionmaker[AsyncSession],
+):
+    codes = await get_refferal_codes([email], async_session)
+    return codes[email]
+
+
+async def get_refferal_codes(
+    emails: list[str],
+    async_session: async_sessionmaker[AsyncSession],
+) -> dict[str, Optional[str]]:
+    # Misses are cached as "" so that users without a code are not looked
+    # up again until the entry expires.
+    codes = await refferal_code_cache.get_many(emails)
+    missing = [email for email, code in codes.items() if code is None]
+    if missing:
+        now = utcnow()
+        async with read_session(async_session)() as session:
+            res = await session.execute(
+                select(Users.email, RefferalCode.code, RefferalCode.expires_at)
+                .join(RefferalCode, RefferalCode.user_id == Users.id)
+                .where(
+                    Users.email.in_(missing),
+                    or_(
+                        RefferalCode.expires_at.is_(None),
+                        RefferalCode.expires_at > now,
+                    ),
+                )
+            )
+            rows = res.all()
+        found = dict.fromkeys(missing, "")
+        ttls = {}
+        for email, code, expires_at in rows:
+            found[email] = code
+            if expires_at is not None:
+                ttls[email] = (expires_at - now).total_seconds()
+        await refferal_code_cache.set_many(found, ttls=ttls)
+        codes.update(found)
+    return {email: code or None for email, code in codes.items()}
+
+
+async def delete_expired_refferal_codes(
+    async_session: async_sessionmaker[AsyncSession],
+    limit: int,
 ):
     async with async_session() as session:
+        async with session.begin():
+            res = await session.execute(
+                select(RefferalCode.id, Users.id, Users.email)
+                .join(Users, Users.id == RefferalCode.user_id)
+                .where(RefferalCode.expires_at <= utcnow())
+                .order_by(RefferalCode.expires_at)
+                .limit(limit)
+            )
+            rows = res.all()
+            if rows:
+                await session.execute(
+                    delete(RefferalCode).where(
+                        RefferalCode.id.in_([id for id, _, _ in rows])
+                    )
+                )
+                await session.execute(
+                    _bump_version(
+                        Users.id.in_([user_id for _, user_id, _ in rows])
+                    )
+                )
+    for _, user_id, email in rows:
+        await invalidate_user(user_id, email)
+    return len(rows)
+
+
+async def sweep_expired_refferal_codes(
+    async_session: async_sessionmaker[AsyncSession],
+    chunk_size: int = REFFERAL_CODE_SWEEP_CHUNK,
+):
+    # Short transactions keep the single writer available to requests
+    # between chunks.
+    removed = 0
+    while True:
+        deleted = await delete_expired_refferal_codes(
+            async_session, chunk_size
+        )
+        removed += deleted
+        if deleted < chunk_size:
+            return removed
+        await asyncio.sleep(0)
+
+
+refferal_code_sweeper = Sweeper(
+    sweep_expired_refferal_codes, REFFERAL_CODE_SWEEP_INTERVAL
+)
+registry.register_stats(
+    "refferal_code_sweeper",
+    refferal_code_sweeper.stats,
+    counters=("runs", "removed", "errors"),
+)
+
+
+def _user_refferals_statement(id: int, after: Optional[int] = None):
+    statement = (
+        select(Users.id, Users.username)
+        .join(refferals, refferals.c.ref_id == Users.id)
+        .where(refferals.c.user_id == id)
+        .order_by(refferals.c.ref_id)
+    )
+    if after is not None:
+        statement = statement.where(refferals.c.ref_id > after)
+    return statement
+
+
+async def get_user_refferals_state(
+    id: int,
+    async_session: async_sessionmaker[AsyncSession],
+):
+    has_refferal_code = (
+        select(RefferalCode.id)
+        .where(RefferalCode.user_id == Users.id)
+        .exists()
+        .label("has_refferal_code")
+    )
+    async with read_session(async_session)() as session:
         res = await session.execute(
-            select(Users)
-            .filter(Users.email.in_([email]))
-            .options(noload(Users.ref_users))
+            select(
+                Users.version, Users.refferals_count, has_refferal_code
+            ).where(Users.id == id)
         )
-        await session.commit()
-        user: Optional[Users] = res.scalars().one_or_none()
-        if user and user.refferal_code:
-            return user.refferal_code.code
+        return res.one_or_none()
 
 
 async def get_user_refferals(
     id: int,
     async_session: async_sessionmaker[AsyncSession],
+    limit: Optional[int] = None,
+    after: Optional[int] = None,
+):
+    statement = _user_refferals_statement(id, after)
+    if limit is not None:
+        statement = statement.limit(limit)
+    async with read_session(async_session)() as session:
+        res = await session.execute(statement)
+        return res.all()
+
+
+async def stream_user_refferals(
+    id: int,
+    async_session: async_sessionmaker[AsyncSession],
+    after: Optional[int] = None,
+):
+    statement = _user_refferals_statement(id, after).execution_options(
+        yield_per=REFFERALS_STREAM_CHUNK
+    )
+    async with read_session(async_session)() as session:
+        res = await session.stream(statement)
+        async for row in res:
+            yield row
+
+
+def _downline_cte(id: int, depth: int):
+    root = (
+        select(
+            refferals.c.ref_id.label("id"),
+            literal(1).label("level"),
+            (
+                literal(f",{id},") + cast(refferals.c.ref_id, String) + ","
+            ).label("path"),
+        )
+        .where(refferals.c.user_id == id)
+        .cte("downline", recursive=True)
+    )
+    child = refferals.alias("child")
+    child_key = cast(child.c.ref_id, String) + ","
+    return root.union_all(
+        select(
+            child.c.ref_id,
+            root.c.level + 1,
+            root.c.path + child_key,
+        )
+        .join(child, child.c.user_id == root.c.id)
+        .where(
+            root.c.level < depth,
+            func.instr(root.c.path, "," + child_key) == 0,
+        )
+    )
+
+
+async def get_user_downline(
+    id: int,
+    depth: int,
+    async_session: async_sessionmaker[AsyncSession],
+):
+    downline = _downline_cte(id, depth)
+    async with read_session(async_session)() as session:
+        res = await session.execute(
+            select(downline.c.level, func.count().label("count"))
+            .group_by(downline.c.level)
+            .order_by(downline.c.level)
+        )
+        return res.all()
+
+
+async def get_user_downline_members(
+    id: int,
+    depth: int,
+    async_session: async_sessionmaker[AsyncSession],
+    limit: int,
+):
+    downline = _downline_cte(id, depth)
+    async with read_session(async_session)() as session:
+        res = await session.execute(
+            select(downline.c.id, Users.username, downline.c.level)
+            .join(Users, Users.id == downline.c.id)
+            .order_by(downline.c.level, downline.c.id)
+            .limit(limit)
+        )
+        return res.all()
+
+
+async def get_user_upline(
+    id: int,
+    depth: int,
+    async_session: async_sessionmaker[AsyncSession],
+):
+    async with read_session(async_session)() as session:
+        res = await session.execute(
+            select(Users.id, Users.username, refferal_paths.c.depth)
+            .join(Users, Users.id == refferal_paths.c.ancestor_id)
+            .where(
+                refferal_paths.c.descendant_id == id,
+                refferal_paths.c.depth <= depth,
+            )
+            .order_by(refferal_paths.c.depth)
+        )
+        return res.all()
+
+
+async def user_exists(
+    id: int,
+    async_session: async_sessionmaker[AsyncSession],
+):
+    async with read_session(async_session)() as session:
+        res = await session.execute(select(Users.id).where(Users.id == id))
+        return res.scalar() is not None
+
+
+async def get_user_version(
+    id: int,
+    async_session: async_sessionmaker[AsyncSession],
+) -> Optional[int]:
+    async with read_session(async_session)() as session:
+        res = await session.execute(
+            select(Users.version).where(Users.id == id)
+        )
+        return res.scalar()
+
+
+async def get_user_version_by_email(
+    email: str,
+    async_session: async_sessionmaker[AsyncSession],
+):
+    # Codes expire without bumping the version, so the expiry of the live
+    # code is part of the state as well.
+    live_code = (
+        RefferalCode.user_id == Users.id,
+        or_(
+            RefferalCode.expires_at.is_(None),
+            RefferalCode.expires_at > utcnow(),
+        ),
+    )
+    has_refferal_code = (
+        select(RefferalCode.id)
+        .where(*live_code)
+        .exists()
+        .label("has_refferal_code")
+    )
+    code_expires_at = (
+        select(func.max(RefferalCode.expires_at))
+        .where(*live_code)
+        .scalar_subquery()
+        .label("code_expires_at")
+    )
+    async with read_session(async_session)() as session:
+        res = await session.execute(
+            select(
+                Users.id, Users.version, has_refferal_code, code_expires_at
+            ).where(Users.email == email)
+        )
+        return res.one_or_none()
+
+
+async def get_user_refferal_counters(
+    id: int,
+    async_session: async_sessionmaker[AsyncSession],
+):
+    async with read_session(async_session)() as session:
+        res = await session.execute(
+            select(Users.refferals_count, Users.downline_count).where(
+                Users.id == id
+            )
+        )
+        return res.one_or_none()
+
+
+_COUNTERS_CTE = """
+WITH RECURSIVE pairs(ancestor_id, id) AS (
+    SELECT user_id, ref_id FROM refferals
+    UNION
+    SELECT pairs.ancestor_id, refferals.ref_id
+    FROM pairs JOIN refferals ON refferals.user_id = pairs.id
+),
+counters(id, refferals_count, downline_count) AS (
+    SELECT
+        users.id,
+        coalesce(direct.count, 0),
+        coalesce(downline.count, 0)
+    FROM users
+    LEFT JOIN (
+        SELECT user_id AS id, count(*) AS count
+        FROM refferals GROUP BY user_id
+    ) AS direct ON direct.id = users.id
+    LEFT JOIN (
+        SELECT ancestor_id AS id, count(*) AS count
+        FROM pairs WHERE ancestor_id != id GROUP BY ancestor_id
+    ) AS downline ON downline.id = users.id
+)
+"""
+
+
+async def _reconcile_refferal_paths(session: AsyncSession, fix: bool):
+    await session.execute(text("DROP TABLE IF EXISTS temp.expected_paths"))
+    await session.execute(
+        text(
+            """
+            CREATE TEMP TABLE expected_paths (
+                descendant_id INTEGER NOT NULL,
+                ancestor_id INTEGER NOT NULL,
+                depth INTEGER NOT NULL,
+                PRIMARY KEY (descendant_id, ancestor_id)
+            )
+            """
+        )
+    )
+    await session.execute(
+        text(BUILD_REFFERAL_PATHS_SQL.format(table="temp.expected_paths"))
+    )
+    res = await session.execute(
+        text(
+            """
+            SELECT
+                (SELECT count(*) FROM (
+                    SELECT descendant_id, ancestor_id, depth
+                    FROM refferal_paths
+                    EXCEPT
+                    SELECT descendant_id, ancestor_id, depth
+                    FROM temp.expected_paths
+                ))
+                + (SELECT count(*) FROM (
+                    SELECT descendant_id, ancestor_id, depth
+                    FROM temp.expected_paths
+                    EXCEPT
+                    SELECT descendant_id, ancestor_id, depth
+                    FROM refferal_paths
+                ))
+            """
+        )
+    )
+    drift = res.scalar()
+    if fix and drift:
+        await session.execute(delete(refferal_paths))
+        await session.execute(
+            text(
+                "INSERT INTO refferal_paths (descendant_id, ancestor_id, depth) "
+                "SELECT descendant_id, ancestor_id, depth "
+                "FROM temp.expected_paths"
+            )
+        )
+    await session.execute(text("DROP TABLE temp.expected_paths"))
+    return drift
+
+
+async def reconcile_refferal_counters(
+    async_session: async_sessionmaker[AsyncSession],
+    fix: bool = True,
 ):
     async with async_session() as session:
-        res = await session.execute(select(Users).filter(Users.id == id))
-        await session.commit()
-        user: Optional[Users] = res.unique().scalars().one_or_none()
-        if user and user.refferal_code:
-            return user.ref_users
+        async with session.begin():
+            await session.execute(text("DROP TABLE IF EXISTS temp.counters"))
+            await session.execute(
+                text(
+                    "CREATE TEMP TABLE counters AS "
+                    + _COUNTERS_CTE
+                    + "SELECT * FROM counters"
+                )
+            )
+            res = await session.execute(
+                text(
+                    """
+                    SELECT
+                        count(*),
+                        coalesce(sum(
+                            users.refferals_count != counters.refferals_count
+                        ), 0),
+                        coalesce(sum(
+                            users.downline_count != counters.downline_count
+                        ), 0)
+                    FROM users JOIN temp.counters ON counters.id = users.id
+                    """
+                )
+            )
+            checked, refferals_drift, downline_drift = res.one()
+            paths_drift = await _reconcile_refferal_paths(session, fix)
+            if fix and (refferals_drift or downline_drift):
+                await session.execute(
+                    text(
+                        """
+                        UPDATE users
+                        SET refferals_count = counters.refferals_count,
+                            downline_count = counters.downline_count
+                        FROM temp.counters AS counters
+                        WHERE counters.id = users.id
+                          AND (
+                            users.refferals_count != counters.refferals_count
+                            OR users.downline_count != counters.downline_count
+                          )
+                        """
+                    )
+                )
+            await session.execute(text("DROP TABLE temp.counters"))
+    return {
+        "checked": checked,
+        "refferals_count_drift": refferals_drift,
+        "downline_count_drift": downline_drift,
+        "refferal_paths_drift": paths_drift,
+        "fixed": fix,
+    }
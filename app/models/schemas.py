@@ -1,4 +1,4 @@
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 from pydantic import BaseModel
 
@@ -11,9 +11,11 @@ class BaseUser(BaseModel):
 
 
 class ActiveUser(BaseModel):
+    id: Optional[int] = None
     username: str
     email: Optional[str]
     disabled: Optional[bool] = None
+    has_refferal_code: bool = False
 
 
 class Token(BaseModel):
@@ -34,6 +36,15 @@ class ReturnRefCode(BaseModel):
     refferal_code: Optional[str]
 
 
+class RefCodesLookup(BaseModel):
+    emails: List[str]
+
+
+class ReturnRefCodes(BaseModel):
+    refferal_codes: Dict[str, Optional[str]]
+    invalid: List[str]
+
+
 class Refferal(BaseModel):
     id: int
     username: str
@@ -41,3 +52,48 @@ class Refferal(BaseModel):
 
 class ReturnRefferals(BaseModel):
     refferals: List["Refferal"]
+    next_after: Optional[int] = None
+
+
+class DownlineLevel(BaseModel):
+    level: int
+    count: int
+
+
+class DownlineMember(BaseModel):
+    id: int
+    username: str
+    level: int
+
+
+class ReturnDownline(BaseModel):
+    levels: List["DownlineLevel"]
+    total: int
+    members: Optional[List["DownlineMember"]] = None
+
+
+class UplineMember(BaseModel):
+    id: int
+    username: str
+    level: int
+
+
+class ReturnUpline(BaseModel):
+    upline: List["UplineMember"]
+
+
+class ReturnRefferalCounters(BaseModel):
+    refferals_count: int
+    downline_count: int
+
+
+class ImportFailure(BaseModel):
+    line: int
+    username: Optional[str]
+    error: str
+
+
+class ReturnImport(BaseModel):
+    total: int
+    imported: int
+    failed: List["ImportFailure"]
@@ -0,0 +1,61 @@
+import hashlib
+import time
+from typing import Optional
+
+from app.cache import STATS_COUNTERS, LocalCache
+from app.config import PRINCIPAL_CACHE_SIZE, PRINCIPAL_CACHE_TTL
+from app.metrics import registry
+from app.models.schemas import ActiveUser
+
+
+def token_digest(token: str):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class PrincipalCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self._cache = LocalCache(maxsize=maxsize, ttl=ttl)
+        self._digests_by_user: dict[int, set[str]] = {}
+
+    def get(self, token: str) -> Optional[ActiveUser]:
+        return self._cache.get(token_digest(token))
+
+    def set(
+        self,
+        token: str,
+        principal: ActiveUser,
+        expires_at: Optional[float] = None,
+    ):
+        ttl = None
+        if expires_at is not None:
+            ttl = expires_at - time.time()
+        digest = token_digest(token)
+        self._cache.set(digest, principal, ttl)
+        if principal.id is None or digest not in self._cache:
+            return
+        digests = self._digests_by_user.get(principal.id, set())
+        self._digests_by_user[principal.id] = {
+            key for key in digests if key in self._cache
+        } | {digest}
+
+    def invalidate(self, user_id: int):
+        for digest in self._digests_by_user.pop(user_id, ()):
+            self._cache.delete(digest)
+
+    def clear(self):
+        self._cache.clear()
+        self._digests_by_user.clear()
+
+    def stats(self):
+        return self._cache.stats()
+
+
+principal_cache = PrincipalCache(
+    maxsize=PRINCIPAL_CACHE_SIZE, ttl=PRINCIPAL_CACHE_TTL
+)
+registry.register_stats(
+    "cache",
+    principal_cache.stats,
+    {"cache": "principal"},
+    counters=STATS_COUNTERS,
+)
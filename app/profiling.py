@@ -0,0 +1,230 @@
+import contextlib
+import logging
+import time
+from contextvars import ContextVar
+from typing import Any, Callable, Iterator, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app.config import (
+    QUERY_BUDGET_DEFAULT,
+    QUERY_BUDGET_MODE,
+    QUERY_BUDGETS,
+    QUERY_PROFILING,
+    QUERY_REPEAT_THRESHOLD,
+    QUERY_SLOW_LOG,
+    QUERY_SLOW_MS,
+)
+
+logger = logging.getLogger(__name__)
+slow_logger = logging.getLogger("app.slow_queries")
+
+
+class QueryBudgetExceeded(RuntimeError):
+    pass
+
+
+class RequestProfile:
+    def __init__(self, scope: dict[str, Any], budget: Optional[int] = None):
+        self.scope = scope
+        self.budget = budget
+        self.statements = 0
+        self.seconds = 0.0
+        self.counts: dict[str, int] = {}
+
+    @property
+    def route(self):
+        route = self.scope.get("route")
+        path = route.path if route is not None else self.scope["path"]
+        return f"{self.scope['method']} {path}"
+
+    def record(self, statement: str, elapsed: float):
+        self.statements += 1
+        self.seconds += elapsed
+        self.counts[statement] = self.counts.get(statement, 0) + 1
+
+    def repeated(self, threshold: int) -> list[tuple[str, int]]:
+        return [
+            (statement, count)
+            for statement, count in self.counts.items()
+            if count >= threshold
+        ]
+
+
+def parse_budgets(value: str) -> dict[str, int]:
+    budgets = {}
+    for item in value.split(","):
+        route, _, budget = item.strip().rpartition("=")
+        if route:
+            budgets[route.strip()] = int(budget)
+    return budgets
+
+
+_current_profile: ContextVar[Optional[RequestProfile]] = ContextVar(
+    "request_profile", default=None
+)
+
+
+class QueryProfiler:
+    def __init__(
+        self,
+        enabled: bool = False,
+        budgets: Optional[dict[str, int]] = None,
+        default_budget: int = 0,
+        mode: str = "warn",
+        repeat_threshold: int = 3,
+    ):
+        if mode not in ("warn", "fail"):
+            raise ValueError(f"Unknown query budget mode: {mode}")
+        self.enabled = enabled
+        self.budgets = budgets or {}
+        self.default_budget = default_budget
+        self.mode = mode
+        self.repeat_threshold = repeat_threshold
+        self._listeners: list[Callable[[RequestProfile], Any]] = []
+
+    def budget_for(self, route: str) -> Optional[int]:
+        return self.budgets.get(route, self.default_budget) or None
+
+    def before_statement(self, profile: RequestProfile):
+        if self.mode != "fail":
+            return
+        if profile.budget is None:
+            profile.budget = self.budget_for(profile.route) or 0
+        if profile.budget and profile.statements >= profile.budget:
+            raise QueryBudgetExceeded(
+                f"{profile.route} exceeded its budget of "
+                f"{profile.budget} statements"
+            )
+
+    def finish(self, profile: RequestProfile):
+        route = profile.route
+        logger.info(
+            "%s: %s statements, %.1f ms in the database",
+            route,
+            profile.statements,
+            profile.seconds * 1000,
+        )
+        for statement, count in profile.repeated(self.repeat_threshold):
+            logger.warning(
+                "%s: same statement ran %s times (possible N+1): %s",
+                route,
+                count,
+                " ".join(statement.split()),
+            )
+        budget = self.budget_for(route)
+        if budget and profile.statements > budget:
+            logger.warning(
+                "%s: %s statements exceed the budget of %s",
+                route,
+                profile.statements,
+                budget,
+            )
+        for listener in self._listeners:
+            listener(profile)
+
+    @contextlib.contextmanager
+    def recording(
+        self, listener: Callable[[RequestProfile], Any]
+    ) -> Iterator[None]:
+        enabled = self.enabled
+        self.enabled = True
+        self._listeners.append(listener)
+        try:
+            yield
+        finally:
+            self._listeners.remove(listener)
+            self.enabled = enabled
+
+
+profiler = QueryProfiler(
+    enabled=QUERY_PROFILING,
+    budgets=parse_budgets(QUERY_BUDGETS),
+    default_budget=QUERY_BUDGET_DEFAULT,
+    mode=QUERY_BUDGET_MODE,
+    repeat_threshold=QUERY_REPEAT_THRESHOLD,
+)
+
+_slow_log_handler: Optional[logging.Handler] = None
+
+
+def configure_slow_log(path: Optional[str]):
+    global _slow_log_handler
+    if _slow_log_handler is not None:
+        slow_logger.removeHandler(_slow_log_handler)
+        _slow_log_handler.close()
+        _slow_log_handler = None
+    slow_logger.propagate = not path
+    if path:
+        _slow_log_handler = logging.FileHandler(path)
+        _slow_log_handler.setFormatter(
+            logging.Formatter("%(asctime)s %(message)s")
+        )
+        slow_logger.addHandler(_slow_log_handler)
+        slow_logger.setLevel(logging.WARNING)
+
+
+configure_slow_log(QUERY_SLOW_LOG)
+
+
+class ProfilerMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not profiler.enabled:
+            await self.app(scope, receive, send)
+            return
+        profile = RequestProfile(scope)
+        token = _current_profile.set(profile)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _current_profile.reset(token)
+            profiler.finish(profile)
+
+
+def _truncate(value: Any, limit: int = 1000):
+    text = repr(value)
+    return text if len(text) <= limit else text[:limit] + "..."
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_execute(conn, cursor, statement, params, context, many):
+    profile = _current_profile.get()
+    if profile is None and not QUERY_SLOW_MS:
+        return
+    if profile is not None:
+        profiler.before_statement(profile)
+    conn.info["profile_start"] = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_execute(conn, cursor, statement, params, context, many):
+    start = conn.info.pop("profile_start", None)
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    profile = _current_profile.get()
+    if profile is not None:
+        profile.record(statement, elapsed)
+    if QUERY_SLOW_MS and elapsed * 1000 >= QUERY_SLOW_MS:
+        message = "%.1f ms%s: %s"
+        args = [
+            elapsed * 1000,
+            f" [{profile.route}]" if profile is not None else "",
+            " ".join(statement.split()),
+        ]
+        # Bound parameters carry password hashes and emails, so they only
+        # go to the dedicated file, which does not propagate to app logs.
+        if _slow_log_handler is not None:
+            message += " params=%s"
+            args.append(_truncate(params))
+        slow_logger.warning(message, *args)
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(context):
+    if context.connection is not None:
+        context.connection.info.pop("profile_start", None)
@@ -1,16 +1,25 @@
 from datetime import timedelta
-from typing import Annotated
+import secrets
+from typing import Annotated, Optional
 
-from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi import APIRouter, Depends, Header, HTTPException, Request
 from fastapi.responses import JSONResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 from starlette import status
 
-from app.config import ACCESS_TOKEN_EXPIRE_MINUTES
+from app.admission import login_admission, register_admission
+from app.config import ACCESS_TOKEN_EXPIRE_MINUTES, IMPORT_API_KEY
 from app.dependencies import get_async_session
-from app.models.queries import register_a_user
-from app.models.schemas import ActiveUser, BaseUser, ReturnModel, Token
+from app.imports import import_users, iter_lines, parse_rows
+from app.models.queries import RegistrationStatus, register_a_user
+from app.models.schemas import (
+    ActiveUser,
+    BaseUser,
+    ReturnImport,
+    ReturnModel,
+    Token,
+)
 from app.utils import (
     authenticate_user,
     compile_user_data,
@@ -18,6 +27,12 @@ from app.utils import (
     get_current_active_user,
 )
 
+REGISTRATION_ERRORS = {
+    RegistrationStatus.username_taken: "Nickname is already taken",
+    RegistrationStatus.email_taken: "Email is already taken",
+    RegistrationStatus.conflict: "Nickname or email is already taken",
+}
+
 router = APIRouter(
     prefix="/api/accounts",
     tags=["accounts"],
@@ -25,7 +40,11 @@ router = APIRouter(
 )
 
 
-@router.post("/register/", response_model=ReturnModel)
+@router.post(
+    "/register/",
+    response_model=ReturnModel,
+    dependencies=[Depends(register_admission)],
+)
 async def register(
     user_data: BaseUser,
     request: Request,
@@ -33,12 +52,13 @@ async def register(
         async_sessionmaker[AsyncSession], Depends(get_async_session)
     ],
 ):
-    user_data_compiled = compile_user_data(user_data.model_dump())
+    register_admission.check_username(user_data.username)
+    user_data_compiled = await compile_user_data(user_data.model_dump())
     res = await register_a_user(
         user_data=user_data_compiled,
         async_session=async_session,
     )
-    if res:
+    if res.status is RegistrationStatus.created:
         return JSONResponse(
             status_code=201,
             content={"result": True, "msg": "Success user registration"},
@@ -48,20 +68,23 @@ async def register(
         status_code=404,
         content={
             "result": False,
-            "msg": (
-                "Error during registration. Nickname or email is already taken"
-            ),
+            "msg": f"Error during registration. {REGISTRATION_ERRORS[res.status]}",
         },
     )
 
 
-@router.post("/login", response_model=Token)
+@router.post(
+    "/login",
+    response_model=Token,
+    dependencies=[Depends(login_admission)],
+)
 async def login_for_access_token(
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
     async_session: Annotated[
         async_sessionmaker[AsyncSession], Depends(get_async_session)
     ],
 ) -> Token:
+    login_admission.check_username(form_data.username)
     user = await authenticate_user(
         form_data.username, form_data.password, async_session
     )
@@ -76,3 +99,26 @@ async def login_for_access_token(
         data={"sub": user.username}, expires_delta=access_token_expires
     )
     return Token(access_token=access_token, token_type="bearer")
+
+
+@router.post("/import", response_model=ReturnModel | ReturnImport)
+async def import_accounts(
+    request: Request,
+    async_session: Annotated[
+        async_sessionmaker[AsyncSession], Depends(get_async_session)
+    ],
+    x_import_key: Annotated[Optional[str], Header()] = None,
+):
+    if not IMPORT_API_KEY or not secrets.compare_digest(
+        x_import_key or "", IMPORT_API_KEY
+    ):
+        return JSONResponse(
+            status_code=403,
+            content={"result": False, "msg": "Import is not allowed"},
+        )
+    content_type = request.headers.get("content-type", "")
+    format = "csv" if content_type.startswith("text/csv") else "ndjson"
+    report = await import_users(
+        parse_rows(iter_lines(request.stream()), format), async_session
+    )
+    return JSONResponse(status_code=200, content={"result": True, **report})
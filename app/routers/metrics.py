@@ -0,0 +1,14 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from app.metrics import registry
+
+router = APIRouter(tags=["metrics"])
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(
+        registry.render(),
+        media_type="text/plain; version=0.0.4; charset=utf-8",
+    )
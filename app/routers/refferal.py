@@ -1,24 +1,47 @@
-from datetime import timedelta
-from typing import Annotated
+from datetime import datetime, timedelta
+import json
+from typing import Annotated, Optional
 
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Header, Query
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, Response, StreamingResponse
 
+from app.config import (
+    DOWNLINE_MAX_DEPTH,
+    DOWNLINE_MEMBERS_MAX,
+    REFFERALS_PAGE_MAX,
+    REFFERAL_CODE_LOOKUP_MAX,
+    REFFERALS_CACHE_MAX_AGE,
+    REFFERALS_PAGE_SIZE,
+    UPLINE_MAX_DEPTH,
+)
 from app.dependencies import get_async_session
-from app.models.models import check_email
+from app.models.models import check_email, is_valid_email
 from app.models.queries import (
     add_refferal_code_to_user,
     delete_ref_code,
     get_refferal_code,
-    get_user_by_username,
+    get_refferal_codes,
+    get_user_downline,
+    get_user_downline_members,
+    get_user_refferal_counters,
     get_user_refferals,
+    get_user_refferals_state,
+    get_user_upline,
+    get_user_version_by_email,
+    stream_user_refferals,
+    user_exists,
 )
 from app.models.schemas import (
     ActiveUser,
+    RefCodesLookup,
+    ReturnDownline,
     ReturnModel,
     ReturnRefCode,
+    ReturnRefCodes,
+    ReturnRefferalCounters,
     ReturnRefferals,
+    ReturnUpline,
 )
 from app.utils import (
     create_access_token,
@@ -31,6 +54,30 @@ router = APIRouter(
     responses={404: {"description": "Not found"}},
 )
 
+# Clients may reuse a response for REFFERALS_CACHE_MAX_AGE seconds and
+# must revalidate it with If-None-Match afterwards.
+CACHE_CONTROL = (
+    f"max-age={REFFERALS_CACHE_MAX_AGE}"
+    if REFFERALS_CACHE_MAX_AGE > 0
+    else "no-cache"
+)
+
+
+def _cache_headers(
+    id: int, version: int, expires_at: Optional[datetime] = None
+):
+    tag = f"{id}-{version}"
+    if expires_at is not None:
+        tag += f"-{int(expires_at.timestamp())}"
+    return {"ETag": f'"{tag}"', "Cache-Control": CACHE_CONTROL}
+
+
+def _not_modified(if_none_match: Optional[str], headers: dict[str, str]):
+    if not if_none_match:
+        return False
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return "*" in tags or headers["ETag"] in tags
+
 
 @router.get("/id/{id}", response_model=ReturnModel | ReturnRefferals)
 async def get_refferals(
@@ -38,24 +85,148 @@ async def get_refferals(
     async_session: Annotated[
         async_sessionmaker[AsyncSession], Depends(get_async_session)
     ],
+    limit: Annotated[
+        int, Query(ge=1, le=REFFERALS_PAGE_MAX)
+    ] = REFFERALS_PAGE_SIZE,
+    after: Optional[int] = None,
+    stream: bool = False,
+    if_none_match: Annotated[Optional[str], Header()] = None,
 ):
-    refferals = await get_user_refferals(id, async_session)
-    if refferals is not None:
+    # Swept codes must not hide referrals that were already made.
+    state = await get_user_refferals_state(id, async_session)
+    if state is None or not (state.has_refferal_code or state.refferals_count):
         return JSONResponse(
-            status_code=200,
+            status_code=404,
             content={
-                "result": True,
-                "refferals": [
-                    {"id": ref.id, "username": ref.username}
-                    for ref in refferals
-                ],
+                "result": False,
+                "msg": "User not found or user doent't have a refferal code.",
             },
         )
+    headers = _cache_headers(id, state.version)
+    if _not_modified(if_none_match, headers):
+        return Response(status_code=304, headers=headers)
+    if stream:
+        return StreamingResponse(
+            _ndjson_refferals(id, async_session, after),
+            media_type="application/x-ndjson",
+            headers=headers,
+        )
+    refferals = await get_user_refferals(
+        id, async_session, limit=limit + 1, after=after
+    )
+    next_after = None
+    if len(refferals) > limit:
+        refferals = refferals[:limit]
+        next_after = refferals[-1].id
     return JSONResponse(
-        status_code=404,
+        status_code=200,
         content={
-            "result": False,
-            "msg": "User not found or user doent't have a refferal code.",
+            "result": True,
+            "refferals": [
+                {"id": ref.id, "username": ref.username} for ref in refferals
+            ],
+            "next_after": next_after,
+        },
+        headers=headers,
+    )
+
+
+async def _ndjson_refferals(
+    id: int,
+    async_session: async_sessionmaker[AsyncSession],
+    after: Optional[int],
+):
+    async for ref in stream_user_refferals(id, async_session, after):
+        yield json.dumps({"id": ref.id, "username": ref.username}) + "\n"
+
+
+@router.get("/count/{id}", response_model=ReturnModel | ReturnRefferalCounters)
+async def get_refferal_counters(
+    id: int,
+    async_session: Annotated[
+        async_sessionmaker[AsyncSession], Depends(get_async_session)
+    ],
+):
+    counters = await get_user_refferal_counters(id, async_session)
+    if counters is None:
+        return JSONResponse(
+            status_code=404,
+            content={"result": False, "msg": "User not found."},
+        )
+    return JSONResponse(
+        status_code=200,
+        content={
+            "result": True,
+            "refferals_count": counters.refferals_count,
+            "downline_count": counters.downline_count,
+        },
+    )
+
+
+@router.get("/downline/{id}", response_model=ReturnModel | ReturnDownline)
+async def get_downline(
+    id: int,
+    async_session: Annotated[
+        async_sessionmaker[AsyncSession], Depends(get_async_session)
+    ],
+    depth: Annotated[int, Query(ge=1, le=DOWNLINE_MAX_DEPTH)] = 1,
+    members: bool = False,
+    limit: Annotated[
+        int, Query(ge=1, le=DOWNLINE_MEMBERS_MAX)
+    ] = REFFERALS_PAGE_SIZE,
+):
+    levels = await get_user_downline(id, depth, async_session)
+    if not levels and not await user_exists(id, async_session):
+        return JSONResponse(
+            status_code=404,
+            content={"result": False, "msg": "User not found."},
+        )
+    content = {
+        "result": True,
+        "levels": [
+            {"level": level.level, "count": level.count} for level in levels
+        ],
+        "total": sum(level.count for level in levels),
+    }
+    if members:
+        content["members"] = [
+            {
+                "id": member.id,
+                "username": member.username,
+                "level": member.level,
+            }
+            for member in await get_user_downline_members(
+                id, depth, async_session, limit
+            )
+        ]
+    return JSONResponse(status_code=200, content=content)
+
+
+@router.get("/upline/{id}", response_model=ReturnModel | ReturnUpline)
+async def get_upline(
+    id: int,
+    async_session: Annotated[
+        async_sessionmaker[AsyncSession], Depends(get_async_session)
+    ],
+    depth: Annotated[int, Query(ge=1, le=UPLINE_MAX_DEPTH)] = UPLINE_MAX_DEPTH,
+):
+    upline = await get_user_upline(id, depth, async_session)
+    if not upline and not await user_exists(id, async_session):
+        return JSONResponse(
+            status_code=404,
+            content={"result": False, "msg": "User not found."},
+        )
+    return JSONResponse(
+        status_code=200,
+        content={
+            "upline": [
+                {
+                    "id": member.id,
+                    "username": member.username,
+                    "level": member.depth,
+                }
+                for member in upline
+            ]
         },
     )
 
@@ -67,17 +238,13 @@ async def create_ref(
         async_sessionmaker[AsyncSession], Depends(get_async_session)
     ],
 ):
-    user = await get_user_by_username(
-        username=current_user.username,
-        async_session=async_session,
-    )
     access_token_expires = timedelta(minutes=30)
     ref_code_token = create_access_token(
         {"email": current_user.email}, access_token_expires
     )
-    if not user.refferal_code:
+    if not current_user.has_refferal_code:
         res = await add_refferal_code_to_user(
-            user.id, ref_code_token, async_session
+            current_user, ref_code_token, async_session
         )
         if res:
             return JSONResponse(
@@ -110,17 +277,12 @@ async def delete_ref(
         async_sessionmaker[AsyncSession], Depends(get_async_session)
     ],
 ):
-    user = await get_user_by_username(
-        username=current_user.username,
-        async_session=async_session,
-    )
-    if not user.refferal_code:
+    if not current_user.has_refferal_code:
         return JSONResponse(
             status_code=400,
             content={"result": False, "msg": "User doesn't have a ref code."},
         )
-    ref_code = user.refferal_code
-    res = await delete_ref_code(ref_code, async_session)
+    res = await delete_ref_code(current_user, async_session)
     if res:
         return JSONResponse(
             status_code=201,
@@ -144,13 +306,21 @@ async def get_ref_code_by_email(
     async_session: Annotated[
         async_sessionmaker[AsyncSession], Depends(get_async_session)
     ],
+    if_none_match: Annotated[Optional[str], Header()] = None,
 ):
     email = check_email(email)
+    user = await get_user_version_by_email(email, async_session)
+    headers = {}
+    if user is not None and user.has_refferal_code:
+        headers = _cache_headers(user.id, user.version, user.code_expires_at)
+        if _not_modified(if_none_match, headers):
+            return Response(status_code=304, headers=headers)
     refferal_code = await get_refferal_code(email, async_session)
     if refferal_code:
         return JSONResponse(
             status_code=200,
             content={"refferal_code": refferal_code},
+            headers=headers,
         )
     return JSONResponse(
         status_code=404,
@@ -159,3 +329,31 @@ async def get_ref_code_by_email(
             "msg": "User not found or user doesn't have refferal code",
         },
     )
+
+
+@router.post("/emails", response_model=ReturnModel | ReturnRefCodes)
+async def get_ref_codes_by_emails(
+    lookup: RefCodesLookup,
+    async_session: Annotated[
+        async_sessionmaker[AsyncSession], Depends(get_async_session)
+    ],
+):
+    if len(lookup.emails) > REFFERAL_CODE_LOOKUP_MAX:
+        return JSONResponse(
+            status_code=422,
+            content={
+                "result": False,
+                "msg": f"At most {REFFERAL_CODE_LOOKUP_MAX} emails "
+                "per request.",
+            },
+        )
+    emails = list(dict.fromkeys(lookup.emails))
+    valid = [email for email in emails if is_valid_email(email)]
+    codes = await get_refferal_codes(valid, async_session) if valid else {}
+    return JSONResponse(
+        status_code=200,
+        content={
+            "refferal_codes": codes,
+            "invalid": [email for email in emails if email not in codes],
+        },
+    )
@@ -0,0 +1,25 @@
+from fastapi import APIRouter
+
+from app.hashing import password_pool
+from app.models.queries import refferal_code_cache, registration_batcher
+
+router = APIRouter(
+    prefix="/api/stats",
+    tags=["stats"],
+    responses={404: {"description": "Not found"}},
+)
+
+
+@router.get("/cache")
+async def get_cache_stats():
+    return {"refferal_code": refferal_code_cache.stats()}
+
+
+@router.get("/password")
+async def get_password_stats():
+    return password_pool.stats()
+
+
+@router.get("/registrations")
+async def get_registration_stats():
+    return registration_batcher.stats()
@@ -0,0 +1,89 @@
+import argparse
+import asyncio
+import os
+
+from app.config import (
+    AUTH_BURST_PER_IP,
+    AUTH_BURST_PER_USERNAME,
+    AUTH_RATE_PER_IP,
+    AUTH_RATE_PER_USERNAME,
+    WEB_HOST,
+    WEB_PORT,
+    WEB_WORKERS,
+)
+
+
+def per_worker_limits(workers: int) -> dict[str, str]:
+    # The admission token buckets live in each worker, so the configured
+    # login/register limits are split between them to keep the total as
+    # configured.
+    return {
+        name: str(value / workers)
+        for name, value in (
+            ("AUTH_RATE_PER_IP", AUTH_RATE_PER_IP),
+            ("AUTH_BURST_PER_IP", AUTH_BURST_PER_IP),
+            ("AUTH_RATE_PER_USERNAME", AUTH_RATE_PER_USERNAME),
+            ("AUTH_BURST_PER_USERNAME", AUTH_BURST_PER_USERNAME),
+        )
+    }
+
+
+async def prepare_database():
+    from app.database.database import (
+        Base,
+        async_session,
+        dispose_sessionmaker,
+        engine,
+    )
+    from app.models.queries import startapp
+
+    await startapp(engine, Base)
+    await dispose_sessionmaker(async_session)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.server")
+    parser.add_argument("--host", default=WEB_HOST)
+    parser.add_argument("--port", type=int, default=WEB_PORT)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=WEB_WORKERS,
+        help="Worker processes, one per core by default",
+    )
+    args = parser.parse_args(argv)
+
+    # Migrate once here so that workers booting side by side only find a
+    # current schema version.
+    asyncio.run(prepare_database())
+    if args.workers > 1:
+        # Workers keep their own principal and referral-code caches, so
+        # writes must reach every worker through the invalidation bus. Each
+        # worker also gets its share of the cores for bcrypt.
+        os.environ["INVALIDATION_BUS"] = "true"
+        os.environ.setdefault(
+            "PASSWORD_HASH_WORKERS",
+            str(max((os.cpu_count() or 1) // args.workers, 1)),
+        )
+        os.environ.update(per_worker_limits(args.workers))
+        # Calibration depends on load, so workers measuring side by side
+        # (or restarting later) would settle on different costs. Measure
+        # once here and hand every worker the same one.
+        from app.hashing import password_rounds
+
+        rounds = password_rounds()
+        if rounds:
+            os.environ["PASSWORD_ROUNDS"] = str(rounds)
+
+    import uvicorn
+
+    uvicorn.run(
+        "app.main:app",
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class Sweeper:
+    def __init__(self, sweep: Callable[..., Awaitable[int]], interval: float):
+        self.sweep = sweep
+        self.interval = interval
+        self.runs = 0
+        self.removed = 0
+        self.errors = 0
+        self.last_seconds = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    async def run_once(self, *args: Any) -> int:
+        start = time.perf_counter()
+        try:
+            removed = await self.sweep(*args)
+        except Exception as exc:
+            self.errors += 1
+            logger.warning("Sweep failed: %s", exc)
+            return 0
+        finally:
+            self.runs += 1
+            self.last_seconds = time.perf_counter() - start
+        self.removed += removed
+        return removed
+
+    async def _run(self, *args: Any):
+        while True:
+            await self.run_once(*args)
+            await asyncio.sleep(self.interval)
+
+    def start(self, *args: Any):
+        if self.interval > 0 and (self._task is None or self._task.done()):
+            loop = asyncio.get_running_loop()
+            self._task = loop.create_task(self._run(*args))
+
+    def stats(self):
+        return {
+            "interval": self.interval,
+            "running": self._task is not None and not self._task.done(),
+            "runs": self.runs,
+            "removed": self.removed,
+            "errors": self.errors,
+            "last_seconds": self.last_seconds,
+        }
+
+    async def close(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
@@ -4,26 +4,26 @@ from typing import Annotated, Any, Optional
 
 from fastapi import Depends, HTTPException
 from fastapi.security import OAuth2PasswordBearer
-from jose import JWTError, jwt
-from passlib.context import CryptContext
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 from starlette import status
 
 from app.config import ALGORITHM, SECRET_KEY
 from app.dependencies import get_async_session
-from app.models.queries import get_user_by_username
+from app.hashing import hash_password, password_pool
+from app.hashing import verify_password as _verify_password
+from app.models.queries import get_user_by_username, update_user_password
 from app.models.schemas import ActiveUser, TokenData
+from app.principals import principal_cache
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/accounts/login")
 
 
 def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    return _verify_password(plain_password, hashed_password)
 
 
 def get_password_hash(password):
-    return pwd_context.hash(password)
+    return hash_password(password)
 
 
 async def authenticate_user(
@@ -34,12 +34,22 @@ async def authenticate_user(
     user = await get_user_by_username(username, async_session)
     if not user:
         return False
-    if not verify_password(password, user.password):
+    verified, new_hash = await password_pool.verify_and_update(
+        password, user.password
+    )
+    if not verified:
         return False
+    if new_hash is not None:
+        await update_user_password(
+            user.id, user.password, new_hash, async_session
+        )
+        user.password = new_hash
     return user
 
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
+    from jose import jwt
+
     to_encode = data.copy()
     if expires_delta:
         expire = datetime.now(timezone.utc) + expires_delta
@@ -61,6 +71,11 @@ async def get_current_user(
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+    principal = principal_cache.get(token)
+    if principal is not None:
+        return principal
+    from jose import JWTError, jwt
+
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: Optional[str] = payload.get("sub")
@@ -76,7 +91,16 @@ async def get_current_user(
     )
     if user is None:
         raise credentials_exception
-    return ActiveUser(**user.__dict__)
+    principal = ActiveUser(
+        id=user.id,
+        username=user.username,
+        email=user.email,
+        has_refferal_code=(
+            user.refferal_code is not None and not user.refferal_code.expired
+        ),
+    )
+    principal_cache.set(token, principal, expires_at=payload.get("exp"))
+    return principal
 
 
 async def get_current_active_user(
@@ -93,9 +117,9 @@ password_validation_exception = HTTPException(
 )
 
 
-def compile_user_data(user_data: dict[str, Any]):
+async def compile_user_data(user_data: dict[str, Any]):
     if not user_data["password"]:
         raise password_validation_exception
-    password_hash = get_password_hash(user_data["password"])
+    password_hash = await password_pool.hash(user_data["password"])
     user_data["password"] = password_hash
     return user_data
@@ -0,0 +1,85 @@
+import argparse
+import asyncio
+import os
+import sqlite3
+import tempfile
+import time
+
+from sqlalchemy.ext.asyncio import (
+    AsyncSession,
+    async_sessionmaker,
+    create_async_engine,
+)
+
+from app.database.database import Base
+from app.models.queries import get_user_downline, get_user_downline_members
+
+
+def build_tree(path: str, nodes: int, fanout: int):
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=OFF")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.executemany(
+        "INSERT INTO users (id, username, password, email) "
+        "VALUES (?, ?, ?, ?)",
+        (
+            (i, f"user{i}", f"hash{i}", f"user{i}@bench.com")
+            for i in range(1, nodes + 1)
+        ),
+    )
+    conn.executemany(
+        "INSERT INTO refferals (user_id, ref_id) VALUES (?, ?)",
+        ((((i - 2) // fanout) + 1, i) for i in range(2, nodes + 1)),
+    )
+    conn.commit()
+    conn.close()
+
+
+async def main(nodes: int, fanout: int, depths: list[int], repeat: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "downline.db")
+        engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+
+        start = time.perf_counter()
+        build_tree(path, nodes, fanout)
+        print(f"built {nodes} nodes in {time.perf_counter() - start:.1f} s")
+
+        async_session = async_sessionmaker(
+            engine, class_=AsyncSession, expire_on_commit=False
+        )
+        for depth in depths:
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                levels = await get_user_downline(1, depth, async_session)
+                timings.append(time.perf_counter() - start)
+            total = sum(level.count for level in levels)
+            print(
+                f"depth={depth:<3} members={total:<9} "
+                f"best={min(timings) * 1000:.1f} ms "
+                f"worst={max(timings) * 1000:.1f} ms"
+            )
+
+        start = time.perf_counter()
+        members = await get_user_downline_members(
+            1, max(depths), async_session, 100
+        )
+        print(
+            f"first {len(members)} members at depth {max(depths)} "
+            f"in {(time.perf_counter() - start) * 1000:.1f} ms"
+        )
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the downline recursive CTE"
+    )
+    parser.add_argument("--nodes", type=int, default=1_000_000)
+    parser.add_argument("--fanout", type=int, default=10)
+    parser.add_argument("--depth", type=int, nargs="+", default=[1, 3, 6])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    asyncio.run(main(args.nodes, args.fanout, args.depth, args.repeat))
@@ -0,0 +1,81 @@
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import httpx
+
+
+async def seed(async_session, users: int):
+    from app.models.models import RefferalCode, Users
+    from app.utils import create_access_token
+
+    async with async_session() as session:
+        async with session.begin():
+            for id in range(1, users + 1):
+                email = f"user{id}@bench.com"
+                session.add(
+                    Users(
+                        id=id,
+                        username=f"user{id}",
+                        password=f"hash{id}",
+                        email=email,
+                    )
+                )
+                if id % 2:
+                    session.add(
+                        RefferalCode(
+                            code=create_access_token({"email": email}),
+                            user_id=id,
+                        )
+                    )
+
+
+async def main(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DATABASE_URL"] = (
+            f"sqlite+aiosqlite:///{os.path.join(tmp, 'lookup.db')}"
+        )
+        from app.database.database import async_session
+        from app.main import app
+        from app.models.queries import refferal_code_cache
+
+        async with app.router.lifespan_context(app):
+            await seed(async_session, args.users)
+            emails = [f"user{id}@bench.com" for id in range(1, args.batch + 1)]
+            async with httpx.AsyncClient(
+                transport=httpx.ASGITransport(app=app),
+                base_url="http://bench",
+            ) as client:
+                for cache in ("cold", "warm"):
+                    if cache == "cold":
+                        refferal_code_cache.local.clear()
+                    start = time.perf_counter()
+                    for email in emails:
+                        await client.get(f"/api/refferal/email/{email}")
+                    single = time.perf_counter() - start
+
+                    if cache == "cold":
+                        refferal_code_cache.local.clear()
+                    start = time.perf_counter()
+                    res = await client.post(
+                        "/api/refferal/emails", json={"emails": emails}
+                    )
+                    batch = time.perf_counter() - start
+                    res.raise_for_status()
+                    print(
+                        f"{cache:<5} single={single / len(emails) * 1e6:8.1f}"
+                        f"us/email batch={batch / len(emails) * 1e6:8.1f}"
+                        f"us/email speedup={single / batch:6.1f}x"
+                    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare per-email referral code lookups with the "
+        "batch endpoint"
+    )
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--batch", type=int, default=1000)
+    asyncio.run(main(parser.parse_args()))
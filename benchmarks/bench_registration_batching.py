@@ -0,0 +1,98 @@
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+from app.batching import WriteBatcher
+from app.database.database import (
+    Base,
+    create_sessionmaker,
+    dispose_sessionmaker,
+)
+from app.models.models import Users
+from app.models.queries import add_user, add_users_batch, startapp
+
+
+async def run_mode(
+    mode: str,
+    clients: int,
+    duration: float,
+    batch_size: int,
+    batch_delay: float,
+):
+    with tempfile.TemporaryDirectory() as tmp:
+        async_session = create_sessionmaker(
+            f"sqlite+aiosqlite:///{os.path.join(tmp, 'bench.db')}"
+        )
+        await startapp(async_session.kw["bind"], Base)
+        batcher = WriteBatcher(
+            add_users_batch, max_items=batch_size, max_delay=batch_delay
+        )
+        latencies: list[float] = []
+        deadline = time.perf_counter() + duration
+
+        async def client(worker: int):
+            sequence = 0
+            while time.perf_counter() < deadline:
+                sequence += 1
+                name = f"{worker}x{sequence}"
+                user = Users(
+                    username=f"user{name}",
+                    password=f"hash{name}",
+                    email=f"{name}@bench.com",
+                )
+                start = time.perf_counter()
+                if mode == "batched":
+                    await batcher.submit(async_session, (user, None))
+                else:
+                    await add_user(user, async_session)
+                latencies.append(time.perf_counter() - start)
+
+        await asyncio.gather(*(client(worker) for worker in range(clients)))
+        stats = batcher.stats()
+        await batcher.close()
+        await dispose_sessionmaker(async_session)
+    latencies.sort()
+    return {
+        "mode": mode,
+        "writes_per_second": len(latencies) / duration,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000,
+        "avg_batch_size": stats["avg_batch_size"],
+    }
+
+
+async def main(args):
+    results = []
+    for mode in args.modes:
+        result = await run_mode(
+            mode,
+            args.clients,
+            args.duration,
+            args.batch_size,
+            args.batch_delay_ms / 1000,
+        )
+        results.append(result)
+        print(
+            f"{mode:<8} writes/s={result['writes_per_second']:<8.0f} "
+            f"p50={result['p50_ms']:.1f}ms p99={result['p99_ms']:.1f}ms "
+            f"batch={result['avg_batch_size']:.1f}"
+        )
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare per-request commits with group-commit batching"
+    )
+    parser.add_argument("--modes", nargs="+", default=["direct", "batched"])
+    parser.add_argument("--clients", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--batch-delay-ms", type=float, default=5)
+    parser.add_argument("--output")
+    asyncio.run(main(parser.parse_args()))
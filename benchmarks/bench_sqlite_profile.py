@@ -0,0 +1,128 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy import insert
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import (
+    AsyncSession,
+    async_sessionmaker,
+    create_async_engine,
+)
+
+from app.database.database import Base, create_engine
+from app.models.models import Users
+from app.models.queries import add_user, get_user_by_username, startapp
+
+
+def build_engine(profile: str, url: str):
+    if profile == "baseline":
+        return create_async_engine(url)
+    return create_engine(url)
+
+
+async def seed(async_session: async_sessionmaker[AsyncSession], users: int):
+    async with async_session() as session:
+        async with session.begin():
+            await session.execute(
+                insert(Users),
+                [
+                    {
+                        "username": f"seed{i}",
+                        "password": f"hash{i}",
+                        "email": f"seed{i}@bench.com",
+                    }
+                    for i in range(users)
+                ],
+            )
+
+
+async def run_profile(
+    profile: str,
+    users: int,
+    readers: int,
+    writers: int,
+    duration: float,
+):
+    with tempfile.TemporaryDirectory() as tmp:
+        url = f"sqlite+aiosqlite:///{os.path.join(tmp, 'bench.db')}"
+        engine = build_engine(profile, url)
+        async_session = async_sessionmaker(
+            engine, class_=AsyncSession, expire_on_commit=False
+        )
+        await startapp(engine, Base)
+        await seed(async_session, users)
+
+        counts = {"reads": 0, "writes": 0, "errors": 0}
+        deadline = time.perf_counter() + duration
+
+        async def reader():
+            while time.perf_counter() < deadline:
+                username = f"seed{random.randrange(users)}"
+                try:
+                    await get_user_by_username(username, async_session)
+                    counts["reads"] += 1
+                except OperationalError:
+                    counts["errors"] += 1
+
+        async def writer(worker: int):
+            sequence = 0
+            while time.perf_counter() < deadline:
+                sequence += 1
+                name = f"w{worker}x{sequence}"
+                user = Users(
+                    username=f"user{name}",
+                    password=f"hash{name}",
+                    email=f"{name}@bench.com",
+                )
+                try:
+                    await add_user(user, async_session)
+                    counts["writes"] += 1
+                except OperationalError:
+                    counts["errors"] += 1
+
+        await asyncio.gather(
+            *(reader() for _ in range(readers)),
+            *(writer(worker) for worker in range(writers)),
+        )
+        await engine.dispose()
+    return {
+        "profile": profile,
+        "reads_per_second": counts["reads"] / duration,
+        "writes_per_second": counts["writes"] / duration,
+        "errors": counts["errors"],
+    }
+
+
+async def main(args):
+    results = []
+    for profile in args.profiles:
+        result = await run_profile(
+            profile, args.users, args.readers, args.writers, args.duration
+        )
+        results.append(result)
+        print(
+            f"{profile:<9} reads/s={result['reads_per_second']:<8.0f} "
+            f"writes/s={result['writes_per_second']:<8.0f} "
+            f"errors={result['errors']}"
+        )
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare SQLite engine profiles under concurrent load"
+    )
+    parser.add_argument("--profiles", nargs="+", default=["baseline", "tuned"])
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--readers", type=int, default=16)
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--output")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,102 @@
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+
+def child():
+    start = time.perf_counter()
+    from app.main import app
+
+    imported = time.perf_counter()
+
+    async def serve():
+        async with app.router.lifespan_context(app):
+            started = time.perf_counter()
+            async with httpx.AsyncClient(
+                transport=httpx.ASGITransport(app=app),
+                base_url="http://startup",
+            ) as client:
+                res = await client.get("/api/refferal/count/1")
+            return started, time.perf_counter(), res.status_code
+
+    started, responded, status = asyncio.run(serve())
+    print(
+        json.dumps(
+            {
+                "import_ms": (imported - start) * 1000,
+                "lifespan_ms": (started - imported) * 1000,
+                "first_request_ms": (responded - started) * 1000,
+                "status": status,
+            }
+        ),
+        flush=True,
+    )
+
+
+def run_child(env: dict[str, str]):
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.bench_startup", "--child"],
+        env=env,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    line = process.stdout.readline()
+    first_response = time.perf_counter() - start
+    process.wait()
+    if process.returncode or not line:
+        raise RuntimeError("Startup run failed")
+    return {**json.loads(line), "first_response_ms": first_response * 1000}
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {
+            **os.environ,
+            "DATABASE_URL": f"sqlite+aiosqlite:///{tmp}/startup.db",
+        }
+        # The first boot creates the schema; the rest measure warm disks.
+        run_child(env)
+        for mode in args.modes:
+            runs = [
+                run_child({**env, "SCHEMA_CHECK": mode})
+                for _ in range(args.repeat)
+            ]
+            medians = {
+                key: statistics.median(run[key] for run in runs)
+                for key in (
+                    "import_ms",
+                    "lifespan_ms",
+                    "first_request_ms",
+                    "first_response_ms",
+                )
+            }
+            print(
+                f"schema_check={mode:<8} "
+                + " ".join(
+                    f"{key}={value:.1f}" for key, value in medians.items()
+                )
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure import time and time to first response of a "
+        "fresh process"
+    )
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--modes", nargs="+", default=["full", "version"])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    if args.child:
+        child()
+    else:
+        main(args)
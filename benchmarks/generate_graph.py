@@ -0,0 +1,262 @@
+import argparse
+import asyncio
+import hashlib
+import random
+import sqlite3
+import time
+from array import array
+from datetime import datetime, timedelta, timezone
+from typing import Iterator
+
+from jose import jwt
+from sqlalchemy import make_url
+
+from app.config import ALGORITHM, DATABASE_URL, SECRET_KEY, SQLITE_PRAGMAS
+from app.database.database import Base, create_engine, is_memory_database
+from app.hashing import get_pwd_context
+from app.models.queries import startapp
+
+BULK_PRAGMAS = {
+    "journal_mode": "OFF",
+    "synchronous": "OFF",
+    "locking_mode": "EXCLUSIVE",
+    "cache_size": -1_048_576,
+    "temp_store": "MEMORY",
+}
+
+
+def generate_graph(
+    users: int,
+    referred_share: float,
+    max_depth: int,
+    seed: int,
+):
+    # Preferential attachment: every user is an entry in `endpoints` once,
+    # plus once per direct referral, so fan-out follows a power law.
+    rng = random.Random(seed)
+    parents = array("i", [0]) * users
+    depths = array("i", [0]) * users
+    endpoints = array("i")
+    for index in range(users):
+        if endpoints and rng.random() < referred_share:
+            parent = endpoints[rng.randrange(len(endpoints))]
+            if depths[parent] < max_depth:
+                parents[index] = parent + 1
+                depths[index] = depths[parent] + 1
+                endpoints.append(parent)
+        endpoints.append(index)
+    return parents, depths
+
+
+def count_refferals(parents: array):
+    refferals_count = array("i", [0]) * len(parents)
+    downline_count = array("i", [0]) * len(parents)
+    # Referrers always precede their referrals, so one reverse pass
+    # rolls every subtree up into its ancestors.
+    for index in range(len(parents) - 1, -1, -1):
+        parent = parents[index]
+        if parent:
+            refferals_count[parent - 1] += 1
+            downline_count[parent - 1] += downline_count[index] + 1
+    return refferals_count, downline_count
+
+
+def chunks(rows: Iterator[tuple], size: int) -> Iterator[list[tuple]]:
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def load(
+    path: str,
+    users: int,
+    referred_share: float,
+    max_depth: int,
+    code_share: float,
+    code_ttl: timedelta,
+    password: str,
+    rounds: int,
+    chunk_size: int,
+    seed: int,
+):
+    started = time.perf_counter()
+
+    def report(message: str):
+        print(f"[{time.perf_counter() - started:7.1f}s] {message}")
+
+    parents, depths = generate_graph(users, referred_share, max_depth, seed)
+    refferals_count, downline_count = count_refferals(parents)
+    report(
+        f"generated {users} users, "
+        f"{sum(1 for parent in parents if parent)} referrals, "
+        f"max fan-out {max(refferals_count, default=0)}, "
+        f"max depth {max(depths, default=0)}"
+    )
+
+    conn = sqlite3.connect(path, isolation_level=None)
+    for name, value in BULK_PRAGMAS.items():
+        conn.execute(f"PRAGMA {name}={value}")
+    offset = conn.execute("SELECT coalesce(max(id), 0) FROM users").fetchone()
+    offset = offset[0]
+
+    password_hash = (
+        get_pwd_context().handler().using(rounds=rounds).hash(password)
+    )
+
+    def user_rows():
+        for index in range(users):
+            id = offset + index + 1
+            yield (
+                id,
+                f"gen{id:09d}",
+                password_hash,
+                f"gen{id:09d}@gen.test",
+                refferals_count[index],
+                downline_count[index],
+            )
+
+    for chunk in chunks(user_rows(), chunk_size):
+        conn.execute("BEGIN")
+        conn.executemany(
+            "INSERT INTO users (id, username, password, email, "
+            "refferals_count, downline_count) VALUES (?, ?, ?, ?, ?, ?)",
+            chunk,
+        )
+        conn.execute("COMMIT")
+    report(f"inserted users {offset + 1}..{offset + users}")
+
+    def refferal_rows():
+        for index, parent in enumerate(parents):
+            if parent:
+                yield offset + parent, offset + index + 1
+
+    for chunk in chunks(refferal_rows(), chunk_size):
+        conn.execute("BEGIN")
+        conn.executemany(
+            "INSERT INTO refferals (user_id, ref_id) VALUES (?, ?)", chunk
+        )
+        conn.execute("COMMIT")
+    report("inserted referrals")
+
+    def path_rows():
+        for index in range(users):
+            parent, depth = parents[index], 1
+            while parent:
+                yield offset + index + 1, offset + parent, depth
+                parent, depth = parents[parent - 1], depth + 1
+
+    paths = 0
+    for chunk in chunks(path_rows(), chunk_size):
+        conn.execute("BEGIN")
+        conn.executemany(
+            "INSERT INTO refferal_paths (descendant_id, ancestor_id, depth) "
+            "VALUES (?, ?, ?)",
+            chunk,
+        )
+        conn.execute("COMMIT")
+        paths += len(chunk)
+    report(f"inserted {paths} referral paths")
+
+    expires_at = (datetime.now(timezone.utc) + code_ttl).replace(microsecond=0)
+    # Same naive UTC text the ORM writes for RefferalCode.expires_at.
+    expires_text = expires_at.replace(tzinfo=None).isoformat(
+        " ", "microseconds"
+    )
+    rng = random.Random(seed + 1)
+
+    def code_rows():
+        for index in range(users):
+            if rng.random() >= code_share:
+                continue
+            id = offset + index + 1
+            code = jwt.encode(
+                {"email": f"gen{id:09d}@gen.test", "exp": expires_at},
+                SECRET_KEY,
+                algorithm=ALGORITHM,
+            )
+            yield (
+                id,
+                code,
+                hashlib.sha256(code.encode()).digest()[:16],
+                expires_text,
+            )
+
+    codes = 0
+    for chunk in chunks(code_rows(), chunk_size):
+        conn.execute("BEGIN")
+        conn.executemany(
+            "INSERT INTO refferal_code (user_id, code, code_key, expires_at) "
+            "VALUES (?, ?, ?, ?)",
+            chunk,
+        )
+        conn.execute("COMMIT")
+        codes += len(chunk)
+    report(f"inserted {codes} referral codes")
+
+    conn.execute("ANALYZE")
+    conn.execute("PRAGMA locking_mode=NORMAL")
+    conn.execute(f"PRAGMA journal_mode={SQLITE_PRAGMAS['journal_mode']}")
+    conn.close()
+    report("done")
+
+
+async def prepare_schema(url: str):
+    engine = create_engine(url)
+    await startapp(engine, Base)
+    await engine.dispose()
+
+
+def main(args):
+    url = args.database_url
+    if make_url(url).get_backend_name() != "sqlite" or is_memory_database(url):
+        raise SystemExit("The loader needs a file-backed SQLite database")
+    asyncio.run(prepare_schema(url))
+    load(
+        make_url(url).database,
+        users=args.users,
+        referred_share=args.referred_share,
+        max_depth=args.max_depth,
+        code_share=args.code_share,
+        code_ttl=timedelta(days=args.code_ttl_days),
+        password=args.password,
+        rounds=args.rounds,
+        chunk_size=args.chunk_size,
+        seed=args.seed,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Generate a deterministic referral graph and bulk load "
+        "it into the configured database"
+    )
+    parser.add_argument("--database-url", default=DATABASE_URL)
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument(
+        "--referred-share",
+        type=float,
+        default=0.8,
+        help="Share of users that registered with a referral code",
+    )
+    parser.add_argument("--max-depth", type=int, default=10)
+    parser.add_argument(
+        "--code-share",
+        type=float,
+        default=0.2,
+        help="Share of users with an active referral code",
+    )
+    parser.add_argument("--code-ttl-days", type=float, default=30)
+    parser.add_argument(
+        "--password",
+        default="password",
+        help="Password of every generated account",
+    )
+    parser.add_argument("--rounds", type=int, default=4)
+    parser.add_argument("--chunk-size", type=int, default=100_000)
+    parser.add_argument("--seed", type=int, default=0)
+    main(parser.parse_args())
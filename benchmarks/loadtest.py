@@ -0,0 +1,374 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import subprocess
+import tempfile
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Optional
+
+import httpx
+
+DEFAULT_MIX = {
+    "register": 5,
+    "login": 5,
+    "create_code": 10,
+    "delete_code": 10,
+    "refferals": 40,
+    "code_by_email": 30,
+}
+
+
+@dataclass
+class Account:
+    username: str
+    email: str
+    password: str
+    token: Optional[str] = None
+    code: Optional[str] = None
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = {}
+        self.statuses: dict[str, dict[str, int]] = {}
+        self.errors: dict[str, int] = {}
+        self.rejected: dict[str, int] = {}
+
+    async def request(
+        self,
+        client: httpx.AsyncClient,
+        route: str,
+        method: str,
+        url: str,
+        **kwargs,
+    ) -> Optional[httpx.Response]:
+        start = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.HTTPError:
+            response = None
+        elapsed = time.perf_counter() - start
+        status = str(response.status_code) if response is not None else "error"
+        statuses = self.statuses.setdefault(route, {})
+        statuses[status] = statuses.get(status, 0) + 1
+        # Shed requests return before doing any work, so they are counted
+        # on their own rather than diluting the latency percentiles.
+        if response is not None and response.status_code == 429:
+            self.rejected[route] = self.rejected.get(route, 0) + 1
+            return response
+        self.latencies.setdefault(route, []).append(elapsed)
+        if response is None or response.status_code >= 500:
+            self.errors[route] = self.errors.get(route, 0) + 1
+        return response
+
+    def reset(self):
+        self.latencies.clear()
+        self.statuses.clear()
+        self.errors.clear()
+        self.rejected.clear()
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, round(q * len(values)) - 1))
+    return values[index]
+
+
+def summarize(
+    latencies: list[float], errors: int, rejected: int, duration: float
+):
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rejected": rejected,
+        "rps": len(latencies) / duration,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "max_ms": (latencies[-1] if latencies else 0.0) * 1000,
+    }
+
+
+class Scenario:
+    def __init__(self, client: httpx.AsyncClient, run_id: str, seed: int):
+        self.client = client
+        self.run_id = run_id
+        self.random = random.Random(seed)
+        self.recorder = Recorder()
+        self.accounts: list[Account] = []
+        self.sequence = 0
+
+    def _new_account(self) -> Account:
+        self.sequence += 1
+        name = f"lt{self.run_id}n{self.sequence}"
+        return Account(
+            username=name, email=f"{name}@load.com", password=f"pw-{name}"
+        )
+
+    def _known_code(self) -> Optional[str]:
+        codes = [a.code for a in self.accounts if a.code]
+        return self.random.choice(codes) if codes else None
+
+    def _headers(self, account: Account):
+        return {"Authorization": f"Bearer {account.token}"}
+
+    async def register(self, account: Optional[Account] = None):
+        account = account or self._new_account()
+        code = self._known_code() if self.random.random() < 0.5 else None
+        response = await self.recorder.request(
+            self.client,
+            "POST /api/accounts/register/",
+            "POST",
+            "/api/accounts/register/",
+            json={
+                "username": account.username,
+                "email": account.email,
+                "password": account.password,
+                "refferal_code": code,
+            },
+        )
+        if response is not None and response.status_code == 201:
+            return account
+        return None
+
+    async def login(self, account: Account):
+        response = await self.recorder.request(
+            self.client,
+            "POST /api/accounts/login",
+            "POST",
+            "/api/accounts/login",
+            data={"username": account.username, "password": account.password},
+        )
+        if response is not None and response.status_code == 200:
+            account.token = response.json()["access_token"]
+
+    async def create_code(self, account: Account):
+        response = await self.recorder.request(
+            self.client,
+            "POST /api/refferal/create",
+            "POST",
+            "/api/refferal/create",
+            headers=self._headers(account),
+        )
+        if response is not None and response.status_code in (201, 400):
+            account.code = (
+                response.json()["refferal_code"]
+                if response.status_code == 201
+                else account.code
+            )
+
+    async def delete_code(self, account: Account):
+        response = await self.recorder.request(
+            self.client,
+            "DELETE /api/refferal/delete",
+            "DELETE",
+            "/api/refferal/delete",
+            headers=self._headers(account),
+        )
+        if response is not None and response.status_code in (201, 400):
+            account.code = None
+
+    async def refferals(self, account: Account):
+        id = self.random.randint(1, max(len(self.accounts), 1))
+        await self.recorder.request(
+            self.client,
+            "GET /api/refferal/id/{id}",
+            "GET",
+            f"/api/refferal/id/{id}",
+        )
+
+    async def code_by_email(self, account: Account):
+        email = self.random.choice(self.accounts).email
+        await self.recorder.request(
+            self.client,
+            "GET /api/refferal/email/{email}",
+            "GET",
+            f"/api/refferal/email/{email}",
+        )
+
+    async def setup(self, users: int, concurrency: int):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def prepare(account: Account):
+            async with semaphore:
+                if await self.register(account) is None:
+                    return
+                await self.login(account)
+                if self.random.random() < 0.5:
+                    await self.create_code(account)
+                self.accounts.append(account)
+
+        accounts = [self._new_account() for _ in range(users)]
+        await asyncio.gather(*(prepare(account) for account in accounts))
+        if not self.accounts:
+            raise RuntimeError("Setup could not register any account")
+
+    async def run(self, mix: dict[str, int], duration: float, clients: int):
+        actions = list(mix)
+        weights = [mix[action] for action in actions]
+        deadline = time.perf_counter() + duration
+
+        async def client(worker: int):
+            account = self.accounts[worker % len(self.accounts)]
+            while time.perf_counter() < deadline:
+                action = self.random.choices(actions, weights)[0]
+                if action == "register":
+                    new_account = await self.register()
+                    if new_account is not None:
+                        self.accounts.append(new_account)
+                else:
+                    await getattr(self, action)(account)
+
+        await asyncio.gather(*(client(worker) for worker in range(clients)))
+
+
+def parse_mix(value: str) -> dict[str, int]:
+    mix = {}
+    for part in value.split(","):
+        action, _, weight = part.partition("=")
+        if action not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f"Unknown action: {action}")
+        mix[action] = int(weight)
+    return mix
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@contextlib.asynccontextmanager
+async def in_process_client(database_url: Optional[str]):
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DATABASE_URL"] = (
+            database_url or f"sqlite+aiosqlite:///{tmp}/loadtest.db"
+        )
+        # Every simulated client shares one address and logs in repeatedly,
+        # so the auth rate limits would shed most of the workload.
+        os.environ["AUTH_RATE_PER_IP"] = "0"
+        os.environ["AUTH_RATE_PER_USERNAME"] = "0"
+        from app.main import app
+
+        async with app.router.lifespan_context(app):
+            async with httpx.AsyncClient(
+                transport=httpx.ASGITransport(app=app),
+                base_url="http://loadtest",
+            ) as client:
+                yield client
+
+
+@contextlib.asynccontextmanager
+async def remote_client(base_url: str, clients: int):
+    limits = httpx.Limits(max_connections=clients)
+    async with httpx.AsyncClient(
+        base_url=base_url, limits=limits, timeout=60
+    ) as client:
+        yield client
+
+
+async def main(args):
+    if args.base_url:
+        context = remote_client(args.base_url, args.clients)
+    else:
+        context = in_process_client(args.database_url)
+    async with context as client:
+        scenario = Scenario(client, args.run_id, args.seed)
+        await scenario.setup(args.users, args.clients)
+        scenario.recorder.reset()
+        start = time.perf_counter()
+        await scenario.run(args.mix, args.duration, args.clients)
+        elapsed = time.perf_counter() - start
+
+    recorder = scenario.recorder
+    routes = {
+        route: {
+            **summarize(
+                recorder.latencies.get(route, []),
+                recorder.errors.get(route, 0),
+                recorder.rejected.get(route, 0),
+                elapsed,
+            ),
+            "statuses": statuses,
+        }
+        for route, statuses in sorted(recorder.statuses.items())
+    }
+    report = {
+        "commit": git_commit(),
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "target": args.base_url or "in-process",
+        "config": {
+            "clients": args.clients,
+            "users": args.users,
+            "duration": args.duration,
+            "mix": args.mix,
+            "seed": args.seed,
+        },
+        "total": summarize(
+            [v for values in recorder.latencies.values() for v in values],
+            sum(recorder.errors.values()),
+            sum(recorder.rejected.values()),
+            elapsed,
+        ),
+        "routes": routes,
+    }
+    for route, stats in [("total", report["total"]), *routes.items()]:
+        print(
+            f"{route:<34} rps={stats['rps']:<8.1f} "
+            f"p50={stats['p50_ms']:<7.1f} p95={stats['p95_ms']:<7.1f} "
+            f"p99={stats['p99_ms']:<7.1f} errors={stats['errors']} "
+            f"rejected={stats['rejected']}"
+        )
+    if args.compare:
+        with open(args.compare) as file:
+            previous = json.load(file)["routes"]
+        print("\nChange against", args.compare)
+        for route, stats in routes.items():
+            if route not in previous:
+                continue
+            before = previous[route]
+            print(
+                f"{route:<34} "
+                f"rps {stats['rps'] / max(before['rps'], 1e-9):>6.2f}x "
+                f"p95 {stats['p95_ms'] / max(before['p95_ms'], 1e-9):>6.2f}x "
+                f"p99 {stats['p99_ms'] / max(before['p99_ms'], 1e-9):>6.2f}x"
+            )
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Drive the API with a mixed workload and report "
+        "per-route latency percentiles"
+    )
+    parser.add_argument(
+        "--base-url",
+        help="Target a running server (e.g. http://127.0.0.1:8000) "
+        "instead of the in-process app",
+    )
+    parser.add_argument(
+        "--database-url", help="Database for the in-process app"
+    )
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--run-id", default=format(int(time.time()) % 100000, "x")
+    )
+    parser.add_argument("--output", help="Write the JSON report here")
+    parser.add_argument("--compare", help="Previous JSON report to diff")
+    asyncio.run(main(parser.parse_args()))
@@ -7,11 +7,15 @@ from sqlalchemy.ext.asyncio import (
     async_sessionmaker,
 )
 from starlette.testclient import TestClient
-from app.database.database import Base
+from app.database.database import (
+    Base,
+    create_sessionmaker,
+    dispose_sessionmaker,
+)
 from app.main import app
 from app.dependencies import get_async_session
 from app.models.models import RefferalCode, Users, refferals
-from app.models.queries import startapp
+from app.models.queries import reconcile_refferal_counters, startapp
 from app.utils import create_access_token, get_password_hash
 
 DATABASE_URL = "sqlite+aiosqlite://"
@@ -73,6 +77,7 @@ async def setUp():
                 refferal_to_insert,
             )
             await session.commit()
+    await reconcile_refferal_counters(_async_session)
 
 
 asyncio.run(setUp())
@@ -86,3 +91,14 @@ def client():
 @pytest.fixture
 def async_session():
     return _async_session
+
+
+@pytest.fixture
+def file_async_session(tmp_path, event_loop, request):
+    session_maker = create_sessionmaker(
+        f"sqlite+aiosqlite:///{tmp_path / 'app.db'}",
+        split_reads=getattr(request, "param", True),
+    )
+    event_loop.run_until_complete(startapp(session_maker.kw["bind"], Base))
+    yield session_maker
+    event_loop.run_until_complete(dispose_sessionmaker(session_maker))
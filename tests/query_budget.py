@@ -0,0 +1,63 @@
+import pytest
+
+from app.profiling import RequestProfile, profiler
+
+
+class QueryCounter:
+    def __init__(self):
+        self.profiles: list[RequestProfile] = []
+
+    def __call__(self, profile: RequestProfile):
+        self.profiles.append(profile)
+
+    def for_route(self, route: str) -> list[RequestProfile]:
+        return [p for p in self.profiles if p.route == route]
+
+    def count(self, route: str) -> int:
+        profiles = self.for_route(route)
+        assert profiles, f"No request to {route} was profiled"
+        return profiles[-1].statements
+
+    def assert_max(self, route: str, budget: int):
+        for profile in self.for_route(route):
+            assert profile.statements <= budget, (
+                f"{route} ran {profile.statements} statements, "
+                f"budget is {budget}:\n" + "\n".join(profile.counts)
+            )
+
+
+@pytest.fixture
+def query_counter():
+    counter = QueryCounter()
+    with profiler.recording(counter):
+        yield counter
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers",
+        "query_budget(max, route=None): fail the test if a request "
+        "(optionally only to `route`) runs more than `max` statements",
+    )
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_call(item):
+    marker = item.get_closest_marker("query_budget")
+    if marker is None:
+        yield
+        return
+    budget = marker.kwargs.get("max", marker.args[0] if marker.args else 0)
+    route = marker.kwargs.get("route")
+    counter = QueryCounter()
+    with profiler.recording(counter):
+        outcome = yield
+    if outcome.excinfo is not None:
+        return
+    for profile in counter.profiles:
+        if route is None or profile.route == route:
+            if profile.statements > budget:
+                pytest.fail(
+                    f"{profile.route} ran {profile.statements} statements, "
+                    f"query_budget is {budget}"
+                )
@@ -0,0 +1,192 @@
+import re
+from datetime import timedelta
+
+import pytest
+from sqlalchemy import event
+
+from app.invalidation import InvalidationBus
+from app.models.models import RefferalCode, Users, utcnow
+from app.models.queries import (
+    _conflict_status,
+    add_refferal_code_to_user,
+    add_user,
+    add_user_and_ref,
+    delete_expired_refferal_codes,
+    delete_ref_code,
+    get_refferal_codes,
+    get_user_by_email,
+    get_user_by_username,
+    get_user_downline,
+    get_user_downline_members,
+    get_user_refferal_counters,
+    get_user_refferals,
+    get_user_refferals_state,
+    get_user_upline,
+    get_user_version,
+    get_user_version_by_email,
+    is_ref_valid,
+    refferal_code_cache,
+    update_user_password,
+)
+from app.models.schemas import ActiveUser
+from app.utils import create_access_token
+
+# Recursive CTEs are walked row by row by design; every table (or alias of
+# one) has to be reached through an index or the rowid.
+SCAN = re.compile(r"^SCAN (\w+)")
+CTES = {"downline"}
+
+
+def _user(id: int):
+    return ActiveUser(id=id, username=f"plan{id}", email=f"plan{id}@gmail.com")
+
+
+async def _register(session_maker, code):
+    await add_user_and_ref(
+        _user(1),
+        Users(username="plan9", password="hash", email="plan9@gmail.com"),
+        session_maker,
+    )
+
+
+async def _conflict(session_maker, code):
+    await _conflict_status(
+        Users(username="plan1", password="hash", email="plan2@gmail.com"),
+        session_maker,
+    )
+
+
+async def _invalidation_bus(session_maker, code):
+    bus = InvalidationBus(lambda *args: None, enabled=True)
+    await bus.start(session_maker)
+    await bus.publish(1, "plan1@gmail.com")
+    await bus.poll()
+    await bus.prune()
+    await bus.close()
+
+
+async def _refferal_codes(session_maker, code):
+    refferal_code_cache.local.clear()
+    await get_refferal_codes(
+        ["plan1@gmail.com", "plan2@gmail.com"], session_maker
+    )
+
+
+async def _delete_expired(session_maker, code):
+    await delete_expired_refferal_codes(session_maker, 100)
+
+
+HOT_QUERIES = {
+    "get_user_by_username": lambda s, _: get_user_by_username("plan1", s),
+    "get_user_by_email": lambda s, _: get_user_by_email("plan1@gmail.com", s),
+    "get_user_version": lambda s, _: get_user_version(1, s),
+    "get_user_version_by_email": lambda s, _: get_user_version_by_email(
+        "plan1@gmail.com", s
+    ),
+    "get_user_refferal_counters": lambda s, _: get_user_refferal_counters(
+        1, s
+    ),
+    "get_user_refferals_state": lambda s, _: get_user_refferals_state(1, s),
+    "get_user_refferals": lambda s, _: get_user_refferals(1, s, 10, 2),
+    "get_user_downline": lambda s, _: get_user_downline(1, 3, s),
+    "get_user_downline_members": lambda s, _: get_user_downline_members(
+        1, 3, s, 10
+    ),
+    "get_user_upline": lambda s, _: get_user_upline(3, 3, s),
+    "get_refferal_codes": _refferal_codes,
+    "is_ref_valid": lambda s, code: is_ref_valid(code, s),
+    "register": _register,
+    "conflict_status": _conflict,
+    "update_user_password": lambda s, _: update_user_password(
+        2, "hash", "rehash", s
+    ),
+    "add_refferal_code_to_user": lambda s, _: add_refferal_code_to_user(
+        _user(2), create_access_token({"email": "plan2@gmail.com"}), s
+    ),
+    "delete_ref_code": lambda s, _: delete_ref_code(_user(2), s),
+    "delete_expired_refferal_codes": _delete_expired,
+    "invalidation_bus": _invalidation_bus,
+}
+
+
+async def _seed(session_maker):
+    for id in range(1, 5):
+        await add_user(
+            Users(
+                username=f"plan{id}",
+                password="hash",
+                email=f"plan{id}@gmail.com",
+            ),
+            session_maker,
+        )
+    await add_user_and_ref(
+        _user(1),
+        Users(username="plan5", password="hash", email="plan5@gmail.com"),
+        session_maker,
+    )
+    # Tokens minted in different seconds differ, so the seeded code is
+    # handed to the queries as is.
+    code = create_access_token({"email": "plan1@gmail.com"})
+    async with session_maker() as session:
+        async with session.begin():
+            session.add_all(
+                [
+                    RefferalCode(code=code, user_id=1),
+                    RefferalCode(
+                        code=create_access_token(
+                            {"email": "plan3@gmail.com"},
+                            timedelta(seconds=-1),
+                        ),
+                        user_id=3,
+                        expires_at=utcnow(),
+                    ),
+                ]
+            )
+    return code
+
+
+async def _explain(session_maker, statement: str, params):
+    async with session_maker.kw["bind"].connect() as conn:
+        res = await conn.exec_driver_sql(
+            f"EXPLAIN QUERY PLAN {statement}", params
+        )
+        return [detail for *_, detail in res.all()]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("file_async_session", [False], indirect=True)
+@pytest.mark.parametrize("name", HOT_QUERIES)
+async def test_hot_queries_use_indexes(file_async_session, name):
+    session_maker = file_async_session
+    code = await _seed(session_maker)
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if executemany:
+            parameters = parameters[0]
+        statements.append((statement, tuple(parameters)))
+
+    engine = session_maker.kw["bind"].sync_engine
+    event.listen(engine, "before_cursor_execute", capture)
+    try:
+        await HOT_QUERIES[name](session_maker, code)
+    finally:
+        event.remove(engine, "before_cursor_execute", capture)
+
+    statements = [
+        (statement, params)
+        for statement, params in statements
+        if not statement.lstrip().upper().startswith("PRAGMA")
+    ]
+    assert statements, f"{name} ran no statements"
+    for statement, params in statements:
+        plan = await _explain(session_maker, statement, params)
+        scans = [
+            detail
+            for detail in plan
+            if "AUTOMATIC" in detail
+            or (SCAN.match(detail) and SCAN.match(detail)[1] not in CTES)
+        ]
+        assert not scans, f"{name} scans a table:\n{statement}\n" + "\n".join(
+            plan
+        )
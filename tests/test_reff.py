@@ -1,7 +1,75 @@
+import asyncio
+from datetime import timedelta
+import json
 import time
+
+from fastapi import HTTPException
 import pytest
+from sqlalchemy import (
+    create_engine as create_sync_engine,
+    delete,
+    func,
+    inspect,
+    select,
+    text,
+    update,
+)
+from sqlalchemy.exc import OperationalError
 
-from app.models.models import Users
+from app.database.database import (
+    Base,
+    create_engine,
+    read_session,
+)
+from app.admission import (
+    TokenBucket,
+    login_admission,
+    register_admission,
+)
+from app.batching import WriteBatcher
+from app.database.migrations import SCHEMA_VERSION, migrate
+from app.imports import iter_lines, parse_rows
+from app.invalidation import InvalidationBus
+from app.server import per_worker_limits
+from app.hashing import (
+    PasswordPool,
+    calibrate_rounds,
+    configure_hashing,
+    get_pwd_context,
+)
+from app.metrics import admission_rejections, db_statement_duration
+from app.profiling import (
+    QueryBudgetExceeded,
+    RequestProfile,
+    configure_slow_log,
+    profiler,
+)
+from app.models.models import (
+    RefferalCode,
+    Users,
+    cache_invalidations,
+    refferal_code_expiry,
+    refferal_code_key,
+    refferals,
+    utcnow,
+)
+from app.models.queries import (
+    RegistrationStatus,
+    add_refferal_code_to_user,
+    add_user,
+    add_user_and_ref,
+    add_users_batch,
+    delete_ref_code,
+    get_user_by_username,
+    get_user_refferal_counters,
+    import_users_chunk,
+    reconcile_refferal_counters,
+    refferal_code_cache,
+    sweep_expired_refferal_codes,
+)
+from app.models.schemas import ActiveUser
+from app.principals import principal_cache
+from app.utils import create_access_token
 
 
 def test_get_refferals(client):
@@ -38,6 +106,12 @@ async def test_register(client, async_session):
 
     fail_res = client.post("api/accounts/register", json=json)
     assert fail_res.status_code == 404
+    assert "Nickname is already taken" in fail_res.json()["msg"]
+
+    json_email_taken = {**json, "username": "testing2"}
+    fail_res = client.post("api/accounts/register", json=json_email_taken)
+    assert fail_res.status_code == 404
+    assert "Email is already taken" in fail_res.json()["msg"]
 
     fail_json_2 = {
         "username": "",
@@ -161,3 +235,1098 @@ async def test_delete_ref_code(client, async_session):
     async with async_session() as session:
         user = await session.get(Users, 3)
         assert user.refferal_code is None
+
+
+@pytest.mark.asyncio
+async def test_password_pool_queue_limit():
+    pool = PasswordPool(workers=1, queue_size=1)
+    first = asyncio.ensure_future(pool.run(time.sleep, 0.2))
+    await asyncio.sleep(0)
+    with pytest.raises(HTTPException) as exc:
+        await pool.hash("password")
+    assert exc.value.status_code == 503
+    await first
+    password_hash = await pool.hash("password")
+    assert await pool.verify("password", password_hash)
+    assert pool.stats()["rejected"] == 1
+    assert pool.stats()["calls"] == 3
+    pool.shutdown()
+
+
+def test_principal_cache_invalidation(client, query_counter, monkeypatch):
+    data = {
+        "username": "username2",
+        "password": "password",
+    }
+    res_token = client.post(
+        "api/accounts/login",
+        data=data,
+        headers={"Content-Type": "application/x-www-form-urlencoded"},
+    )
+    headers = {"Authorization": f"Bearer {res_token.json()['access_token']}"}
+
+    assert (
+        client.post("api/refferal/create", headers=headers).status_code == 201
+    )
+    assert (
+        client.post("api/refferal/create", headers=headers).status_code == 400
+    )
+    assert (
+        client.delete("api/refferal/delete", headers=headers).status_code
+        == 201
+    )
+    assert (
+        client.delete("api/refferal/delete", headers=headers).status_code
+        == 400
+    )
+
+    def user_selects():
+        profile = query_counter.for_route("DELETE /api/refferal/delete")[-1]
+        return sum(
+            count
+            for statement, count in profile.counts.items()
+            if statement.startswith("SELECT") and "FROM users" in statement
+        )
+
+    assert user_selects() == 1
+    client.delete("api/refferal/delete", headers=headers)
+    assert user_selects() == 0
+
+    monkeypatch.setattr(principal_cache._cache, "ttl", 0.2)
+    principal_cache.clear()
+    client.delete("api/refferal/delete", headers=headers)
+    assert user_selects() == 1
+    time.sleep(0.3)
+    client.delete("api/refferal/delete", headers=headers)
+    assert user_selects() == 1
+
+
+def test_get_refferals_pagination(client):
+    all_refferals = client.get("/api/refferal/id/1").json()["refferals"]
+    assert len(all_refferals) >= 2
+
+    page = client.get("/api/refferal/id/1", params={"limit": 1}).json()
+    assert page["refferals"] == all_refferals[:1]
+    assert page["next_after"] == all_refferals[0]["id"]
+
+    rest = client.get(
+        "/api/refferal/id/1", params={"after": page["next_after"]}
+    ).json()
+    assert rest["refferals"] == all_refferals[1:]
+    assert rest["next_after"] is None
+
+    res = client.get("/api/refferal/id/1", params={"stream": True})
+    assert res.status_code == 200
+    assert res.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in res.text.splitlines()]
+    assert lines == all_refferals
+
+    fail_res = client.get("/api/refferal/id/2", params={"stream": True})
+    assert fail_res.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_get_downline(client, async_session):
+    async with async_session() as session:
+        await session.execute(
+            refferals.insert().values(), [{"user_id": 2, "ref_id": 3}]
+        )
+        await session.commit()
+
+    res = client.get("/api/refferal/downline/1", params={"depth": 3})
+    assert res.status_code == 200
+    levels = {level["level"]: level["count"] for level in res.json()["levels"]}
+    assert levels[1] >= 2
+    assert levels[2] == 1
+    assert 3 not in levels
+
+    shallow = client.get("/api/refferal/downline/1", params={"members": True})
+    assert [level["level"] for level in shallow.json()["levels"]] == [1]
+    assert {member["level"] for member in shallow.json()["members"]} == {1}
+
+    async with async_session() as session:
+        await session.execute(
+            refferals.insert().values(), [{"user_id": 3, "ref_id": 1}]
+        )
+        await session.commit()
+    cyclic = client.get("/api/refferal/downline/1", params={"depth": 10})
+    assert cyclic.status_code == 200
+    assert cyclic.json()["total"] == res.json()["total"]
+
+    async with async_session() as session:
+        await session.execute(
+            refferals.delete().where(
+                refferals.c.user_id.in_([2, 3]), refferals.c.ref_id.in_([1, 3])
+            )
+        )
+        await session.commit()
+
+    assert client.get("/api/refferal/downline/999").status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_refferal_counters(client, async_session):
+    refferals_list = client.get("/api/refferal/id/1").json()["refferals"]
+    res = client.get("/api/refferal/count/1")
+    assert res.status_code == 200
+    assert res.json()["refferals_count"] == len(refferals_list)
+    downline = client.get("/api/refferal/downline/1", params={"depth": 10})
+    assert res.json()["downline_count"] == downline.json()["total"]
+    assert client.get("/api/refferal/count/999").status_code == 404
+
+    async with async_session() as session:
+        await session.execute(
+            update(Users).where(Users.id == 1).values(refferals_count=0)
+        )
+        await session.commit()
+    report = await reconcile_refferal_counters(async_session, fix=False)
+    assert report["refferals_count_drift"] == 1
+    report = await reconcile_refferal_counters(async_session)
+    assert report["refferals_count_drift"] == 1
+    report = await reconcile_refferal_counters(async_session)
+    assert report["refferals_count_drift"] == 0
+    assert report["downline_count_drift"] == 0
+    assert client.get("/api/refferal/count/1").json() == res.json()
+
+
+@pytest.mark.asyncio
+async def test_import_accounts(client, async_session, monkeypatch):
+    lines = [
+        {"username": "import1", "email": "import1@gmail.com", "password": "p"},
+        {"username": "import1", "email": "import9@gmail.com", "password": "p"},
+        {"username": "import2", "email": "bad-email", "password": "p"},
+        {
+            "username": "username1",
+            "email": "import3@gmail.com",
+            "password": "p",
+        },
+        {
+            "username": "import4",
+            "email": "import4@gmail.com",
+            "password": "p",
+            "refferal_code": "invalid",
+        },
+    ]
+    body = "\n".join(json.dumps(line) for line in lines) + "\nnot json\n"
+
+    res = client.post("api/accounts/import", content=body)
+    assert res.status_code == 403
+
+    monkeypatch.setattr("app.routers.account.IMPORT_API_KEY", "secret")
+    res = client.post(
+        "api/accounts/import", content=body, headers={"X-Import-Key": "secret"}
+    )
+    assert res.status_code == 200
+    report = res.json()
+    assert report["total"] == 6
+    assert report["imported"] == 1
+    assert [failure["line"] for failure in report["failed"]] == [2, 3, 4, 5, 6]
+
+    ref_code = create_access_token({"email": "email2@gmail.com"})
+    async with async_session() as session:
+        session.add(RefferalCode(code=ref_code, user_id=2))
+        await session.commit()
+    count = client.get("/api/refferal/count/2").json()["refferals_count"]
+    csv_body = (
+        "username,email,password,refferal_code\n"
+        f"import5,import5@gmail.com,p,{ref_code}\n"
+    )
+    res = client.post(
+        "api/accounts/import",
+        content=csv_body,
+        headers={"X-Import-Key": "secret", "Content-Type": "text/csv"},
+    )
+    assert res.json()["imported"] == 1
+    new_count = client.get("/api/refferal/count/2").json()["refferals_count"]
+    assert new_count == count + 1
+
+    async with async_session() as session:
+        res = await session.execute(
+            select(Users.username).where(Users.username.like("import%"))
+        )
+        assert sorted(res.scalars().all()) == ["import1", "import5"]
+
+
+@pytest.mark.asyncio
+async def test_import_rows_survive_bad_input():
+    async def parse(body: bytes, format: str):
+        async def chunks():
+            # Split mid-line to exercise the buffering in iter_lines.
+            yield body[:7]
+            yield body[7:]
+
+        return [row async for row in parse_rows(iter_lines(chunks()), format)]
+
+    csv_body = (
+        b"username,email,password\n"
+        b'multi1,multi1@gmail.com,"first\nsecond"\n'
+        b"\n"
+        b"bad\xff,bad@gmail.com,p\n"
+        b'"quoted, name",q@gmail.com,p\r\n'
+    )
+    assert await parse(csv_body, "csv") == [
+        (
+            2,
+            {
+                "username": "multi1",
+                "email": "multi1@gmail.com",
+                "password": "first\nsecond",
+            },
+        ),
+        (5, None),
+        (
+            6,
+            {
+                "username": "quoted, name",
+                "email": "q@gmail.com",
+                "password": "p",
+            },
+        ),
+    ]
+    ndjson_body = b'{"username": "a"}\n\xff\xfe\n{"username": "b"}\n'
+    assert await parse(ndjson_body, "ndjson") == [
+        (1, {"username": "a"}),
+        (2, None),
+        (3, {"username": "b"}),
+    ]
+
+
+def test_import_reports_undecodable_line(client, monkeypatch):
+    monkeypatch.setattr("app.routers.account.IMPORT_API_KEY", "secret")
+    body = (
+        b'{"username": "decode1", "email": "decode1@gmail.com", '
+        b'"password": "p"}\n'
+        b"\xff\xfe\n"
+    )
+    res = client.post(
+        "api/accounts/import", content=body, headers={"X-Import-Key": "secret"}
+    )
+    assert res.status_code == 200
+    report = res.json()
+    assert report["imported"] == 1
+    assert report["failed"] == [
+        {"line": 2, "username": None, "error": "Invalid row"}
+    ]
+
+
+@pytest.mark.asyncio
+async def test_delete_ref_code_updates_counters(client, async_session):
+    head = ActiveUser(id=4, username="testing", email="testemail@gmail.com")
+    first = await add_user_and_ref(
+        head,
+        Users(username="counter1", password="c1", email="c1@gmail.com"),
+        async_session,
+    )
+    first_principal = ActiveUser(
+        id=first.id, username="counter1", email="c1@gmail.com"
+    )
+    await add_user_and_ref(
+        first_principal,
+        Users(username="counter2", password="c2", email="c2@gmail.com"),
+        async_session,
+    )
+    assert client.get("/api/refferal/count/4").json()["downline_count"] == 2
+
+    assert await delete_ref_code(first_principal, async_session)
+    head_counters = client.get("/api/refferal/count/4").json()
+    assert head_counters["refferals_count"] == 1
+    assert head_counters["downline_count"] == 1
+    first_counters = client.get(f"/api/refferal/count/{first.id}").json()
+    assert first_counters["refferals_count"] == 0
+    assert first_counters["downline_count"] == 0
+
+    report = await reconcile_refferal_counters(async_session, fix=False)
+    assert report["refferals_count_drift"] == 0
+    assert report["downline_count_drift"] == 0
+    assert report["refferal_paths_drift"] == 0
+
+
+@pytest.mark.asyncio
+async def test_get_upline(client, async_session):
+    root = ActiveUser(id=1, username="username1", email="email1@gmail.com")
+    first = await add_user_and_ref(
+        root,
+        Users(username="upline1", password="u1", email="u1@gmail.com"),
+        async_session,
+    )
+    first_principal = ActiveUser(
+        id=first.id, username="upline1", email="u1@gmail.com"
+    )
+    second = await add_user_and_ref(
+        first_principal,
+        Users(username="upline2", password="u2", email="u2@gmail.com"),
+        async_session,
+    )
+
+    res = client.get(f"/api/refferal/upline/{second.id}")
+    assert res.status_code == 200
+    assert res.json()["upline"] == [
+        {"id": first.id, "username": "upline1", "level": 1},
+        {"id": 1, "username": "username1", "level": 2},
+    ]
+    shallow = client.get(
+        f"/api/refferal/upline/{second.id}", params={"depth": 1}
+    )
+    assert [member["id"] for member in shallow.json()["upline"]] == [first.id]
+    assert client.get("/api/refferal/upline/1").json()["upline"] == []
+    assert client.get("/api/refferal/upline/999").status_code == 404
+
+    assert await delete_ref_code(first_principal, async_session)
+    detached = client.get(f"/api/refferal/upline/{second.id}").json()
+    assert detached["upline"] == []
+    assert [
+        member["id"]
+        for member in client.get(f"/api/refferal/upline/{first.id}").json()[
+            "upline"
+        ]
+    ] == [1]
+
+    report = await reconcile_refferal_counters(async_session, fix=False)
+    assert report["refferal_paths_drift"] == 0
+
+
+def test_refferal_code_cache_invalidation(client):
+    data = {"username": "username3", "password": "password"}
+    res_token = client.post(
+        "api/accounts/login",
+        data=data,
+        headers={"Content-Type": "application/x-www-form-urlencoded"},
+    )
+    headers = {"Authorization": f"Bearer {res_token.json()['access_token']}"}
+
+    assert (
+        client.get("/api/refferal/email/email3@gmail.com").status_code == 404
+    )
+    created = client.post("api/refferal/create", headers=headers)
+    assert created.status_code == 201
+    res = client.get("/api/refferal/email/email3@gmail.com")
+    assert res.json()["refferal_code"] == created.json()["refferal_code"]
+
+    hits = client.get("/api/stats/cache").json()["refferal_code"]["hits"]
+    client.get("/api/refferal/email/email3@gmail.com")
+    stats = client.get("/api/stats/cache").json()["refferal_code"]
+    assert stats["hits"] == hits + 1
+
+    assert (
+        client.delete("api/refferal/delete", headers=headers).status_code
+        == 201
+    )
+    assert (
+        client.get("/api/refferal/email/email3@gmail.com").status_code == 404
+    )
+
+
+@pytest.mark.asyncio
+async def test_sweep_expired_refferal_codes(client, async_session):
+    email = "sweep1@gmail.com"
+    created = await add_user(
+        Users(username="sweep1", password="s1", email=email), async_session
+    )
+    principal = ActiveUser(id=created.id, username="sweep1", email=email)
+    expired = create_access_token({"email": email}, timedelta(seconds=-1))
+    async with async_session() as session:
+        session.add(RefferalCode(code=expired, user_id=created.id))
+        await session.commit()
+    assert client.get(f"/api/refferal/email/{email}").status_code == 404
+
+    await refferal_code_cache.set(email, expired)
+    assert await sweep_expired_refferal_codes(async_session, chunk_size=1)
+    assert await refferal_code_cache.get(email) is None
+    async with async_session() as session:
+        res = await session.execute(
+            select(func.count()).where(RefferalCode.expires_at <= utcnow())
+        )
+        assert res.scalar() == 0
+    # The seeded code of user 1 is long expired and went with the sweep,
+    # but the referrals it brought in are still listed.
+    res = client.get("/api/refferal/id/1")
+    assert res.status_code == 200
+    assert len(res.json()["refferals"]) >= 2
+    # Later tests look up user 1's code by email.
+    root = ActiveUser(id=1, username="username1", email="email1@gmail.com")
+    assert await add_refferal_code_to_user(
+        root,
+        create_access_token({"email": root.email}, timedelta(minutes=5)),
+        async_session,
+    )
+
+    async with async_session() as session:
+        session.add(RefferalCode(code=expired, user_id=created.id))
+        await session.commit()
+    live = create_access_token({"email": email}, timedelta(minutes=5))
+    assert await add_refferal_code_to_user(principal, live, async_session)
+    async with async_session() as session:
+        res = await session.execute(
+            select(RefferalCode.code).where(RefferalCode.user_id == created.id)
+        )
+        assert res.scalars().all() == [live]
+    res = client.get(f"/api/refferal/email/{email}")
+    assert res.json()["refferal_code"] == live
+
+
+def test_get_codes_by_emails(client, query_counter):
+    single = client.get("/api/refferal/email/email2@gmail.com").json()
+    emails = [f"lookup{i}@gmail.com" for i in range(200)]
+    body = {
+        "emails": [
+            "email1@gmail.com",
+            "email2@gmail.com",
+            "email2@gmail.com",
+            "not-an-email",
+            *emails,
+        ]
+    }
+    res = client.post("/api/refferal/emails", json=body)
+    assert res.status_code == 200
+    codes = res.json()["refferal_codes"]
+    assert codes["email1@gmail.com"]
+    assert codes["email2@gmail.com"] == single["refferal_code"]
+    assert len(codes) == 202
+    assert all(codes[email] is None for email in emails)
+    assert res.json()["invalid"] == ["not-an-email"]
+    assert query_counter.count("POST /api/refferal/emails") == 1
+
+    cached = client.post("/api/refferal/emails", json=body)
+    assert cached.json() == res.json()
+    assert query_counter.count("POST /api/refferal/emails") == 0
+
+    too_many = {"emails": ["a@gmail.com"] * 5001}
+    res = client.post("/api/refferal/emails", json=too_many)
+    assert res.status_code == 422
+
+
+def test_migrate_skips_ddl_when_current():
+    engine = create_sync_engine("sqlite://")
+    with engine.begin() as conn:
+        migrate(conn, Base.metadata)
+        version = conn.execute(text("PRAGMA user_version")).scalar()
+        assert version == SCHEMA_VERSION
+        conn.execute(text("DROP TABLE refferal_paths"))
+        migrate(conn, Base.metadata)
+        assert not inspect(conn).has_table("refferal_paths")
+        migrate(conn, Base.metadata, full=True)
+        assert inspect(conn).has_table("refferal_paths")
+    engine.dispose()
+
+
+BASELINE_SCHEMA = [
+    """
+    CREATE TABLE users (
+        id INTEGER NOT NULL,
+        username VARCHAR(50) NOT NULL,
+        password VARCHAR NOT NULL,
+        email VARCHAR(40) NOT NULL,
+        PRIMARY KEY (id),
+        UNIQUE (username),
+        UNIQUE (password),
+        UNIQUE (email)
+    )
+    """,
+    """
+    CREATE TABLE refferal_code (
+        id INTEGER NOT NULL,
+        user_id INTEGER,
+        code VARCHAR,
+        PRIMARY KEY (id),
+        FOREIGN KEY(user_id) REFERENCES users (id),
+        UNIQUE (code)
+    )
+    """,
+    """
+    CREATE TABLE refferals (
+        user_id INTEGER NOT NULL,
+        ref_id INTEGER NOT NULL,
+        PRIMARY KEY (user_id, ref_id),
+        FOREIGN KEY(user_id) REFERENCES users (id),
+        FOREIGN KEY(ref_id) REFERENCES users (id)
+    )
+    """,
+]
+
+
+def test_migrate_baseline_database_with_data(tmp_path):
+    engine = create_sync_engine(f"sqlite:///{tmp_path / 'baseline.db'}")
+    code = create_access_token({"email": "base1@gmail.com"})
+    with engine.begin() as conn:
+        for ddl in BASELINE_SCHEMA:
+            conn.execute(text(ddl))
+        conn.execute(
+            text(
+                "INSERT INTO users (id, username, password, email) "
+                "VALUES (:id, :username, :password, :email)"
+            ),
+            [
+                {
+                    "id": id,
+                    "username": f"base{id}",
+                    "password": f"hash{id}",
+                    "email": f"base{id}@gmail.com",
+                }
+                for id in range(1, 5)
+            ],
+        )
+        conn.execute(
+            text("INSERT INTO refferals VALUES (:user_id, :ref_id)"),
+            [
+                {"user_id": 1, "ref_id": 2},
+                {"user_id": 1, "ref_id": 3},
+                {"user_id": 3, "ref_id": 4},
+            ],
+        )
+        conn.execute(
+            text(
+                "INSERT INTO refferal_code (user_id, code) VALUES (1, :code)"
+            ),
+            {"code": code},
+        )
+
+    with engine.begin() as conn:
+        migrate(conn, Base.metadata)
+
+    with engine.begin() as conn:
+        assert conn.execute(text("PRAGMA user_version")).scalar() == 7
+        assert SCHEMA_VERSION == 7
+        users = conn.execute(
+            text(
+                "SELECT id, username, password, email, refferals_count, "
+                "downline_count, version FROM users ORDER BY id"
+            )
+        ).all()
+        assert users == [
+            (1, "base1", "hash1", "base1@gmail.com", 2, 3, 0),
+            (2, "base2", "hash2", "base2@gmail.com", 0, 0, 0),
+            (3, "base3", "hash3", "base3@gmail.com", 1, 1, 0),
+            (4, "base4", "hash4", "base4@gmail.com", 0, 0, 0),
+        ]
+        assert conn.execute(
+            select(
+                RefferalCode.user_id,
+                RefferalCode.code,
+                RefferalCode.code_key,
+                RefferalCode.expires_at,
+            )
+        ).all() == [
+            (1, code, refferal_code_key(code), refferal_code_expiry(code))
+        ]
+        assert conn.execute(
+            text("SELECT user_id, ref_id FROM refferals ORDER BY 1, 2")
+        ).all() == [(1, 2), (1, 3), (3, 4)]
+        assert conn.execute(
+            text(
+                "SELECT descendant_id, ancestor_id, depth "
+                "FROM refferal_paths ORDER BY 1, 2"
+            )
+        ).all() == [(2, 1, 1), (3, 1, 1), (4, 1, 2), (4, 3, 1)]
+        indexes = {
+            index["name"]
+            for table in (
+                "users",
+                "refferal_code",
+                "refferals",
+                "refferal_paths",
+            )
+            for index in inspect(conn).get_indexes(table)
+        }
+        assert {
+            "ix_refferal_code_user_id",
+            "ix_refferal_code_expires_at",
+            "ix_refferals_ref_id",
+            "ix_refferal_paths_ancestor_id_depth",
+        } <= indexes
+        # Password hashes no longer have to be unique.
+        conn.execute(
+            text(
+                "INSERT INTO users (username, password, email) "
+                "VALUES ('base5', 'hash1', 'base5@gmail.com')"
+            )
+        )
+    engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_concurrent_registrations(file_async_session):
+    head = await add_user(
+        Users(username="referrer", password="head", email="head@gmail.com"),
+        file_async_session,
+    )
+    head_user = ActiveUser(
+        id=head.id, username="referrer", email="head@gmail.com"
+    )
+
+    total = 2000
+    results = await asyncio.gather(
+        *(
+            add_user_and_ref(
+                head_user,
+                Users(
+                    username=f"parallel{i}",
+                    password=f"hash{i}",
+                    email=f"parallel{i}@gmail.com",
+                ),
+                file_async_session,
+            )
+            for i in range(total)
+        ),
+        add_user_and_ref(
+            head_user,
+            Users(username="parallel0", password="dup", email="dup@gmail.com"),
+            file_async_session,
+        ),
+    )
+    statuses = [result.status for result in results]
+    assert statuses.count(RegistrationStatus.created) == total
+    assert statuses.count(RegistrationStatus.username_taken) == 1
+
+    counters = await get_user_refferal_counters(head.id, file_async_session)
+    assert counters.refferals_count == total
+    assert counters.downline_count == total
+    async with file_async_session() as session:
+        res = await session.execute(
+            select(func.count()).where(refferals.c.user_id == head.id)
+        )
+        assert res.scalar() == total
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("file_async_session", [True], indirect=True)
+async def test_split_read_write_sessions(file_async_session):
+    reader = read_session(file_async_session)
+    assert reader is not file_async_session
+
+    async def register_and_read(i: int):
+        result = await add_user(
+            Users(
+                username=f"split{i}",
+                password=f"hash{i}",
+                email=f"split{i}@gmail.com",
+            ),
+            file_async_session,
+        )
+        user = await get_user_by_username(f"split{i}", file_async_session)
+        return result.status, user.id == result.id
+
+    results = await asyncio.gather(*(register_and_read(i) for i in range(50)))
+    assert results == [(RegistrationStatus.created, True)] * 50
+
+    async with reader() as session:
+        with pytest.raises(OperationalError, match="readonly"):
+            await session.execute(delete(Users))
+
+
+@pytest.mark.asyncio
+async def test_invalidation_bus(file_async_session):
+    evicted = {"first": [], "second": []}
+    first = InvalidationBus(
+        lambda *args: evicted["first"].append(args), enabled=True
+    )
+    second = InvalidationBus(
+        lambda *args: evicted["second"].append(args),
+        enabled=True,
+        interval=0.005,
+    )
+    await first.start(file_async_session)
+    await second.start(file_async_session)
+
+    await asyncio.gather(
+        first.publish(1, "one@gmail.com"), first.publish(2, None)
+    )
+    for _ in range(200):
+        if len(evicted["second"]) == 2:
+            break
+        await asyncio.sleep(0.005)
+    assert evicted["second"] == [(1, "one@gmail.com"), (2, None)]
+    assert first.published == 2
+
+    await first.poll()
+    assert evicted["first"] == []
+
+    first.retention = 0
+    await first.prune()
+    async with file_async_session() as session:
+        res = await session.execute(
+            select(func.count()).select_from(cache_invalidations)
+        )
+        assert res.scalar() == 0
+    await first.close()
+    await second.close()
+
+
+@pytest.mark.asyncio
+async def test_registration_batcher(file_async_session):
+    head = await add_user(
+        Users(username="batchhead", password="head", email="bh@gmail.com"),
+        file_async_session,
+    )
+    batcher = WriteBatcher(add_users_batch, max_items=50, max_delay=0.05)
+
+    total = 200
+    results = await asyncio.gather(
+        *(
+            batcher.submit(
+                file_async_session,
+                (
+                    Users(
+                        username=f"batched{i}",
+                        password=f"hash{i}",
+                        email=f"batched{i}@gmail.com",
+                    ),
+                    head.id if i % 2 else None,
+                ),
+            )
+            for i in range(total)
+        ),
+        batcher.submit(
+            file_async_session,
+            (
+                Users(username="batched1", password="dup", email="d@mail.com"),
+                head.id,
+            ),
+        ),
+        batcher.submit(
+            file_async_session,
+            (
+                Users(username="other", password="dup", email="bh@gmail.com"),
+                None,
+            ),
+        ),
+    )
+    statuses = [result.status for result in results]
+    assert statuses[:total] == [RegistrationStatus.created] * total
+    assert statuses[total:] == [
+        RegistrationStatus.username_taken,
+        RegistrationStatus.email_taken,
+    ]
+    assert len({result.id for result in results[:total]}) == total
+
+    stats = batcher.stats()
+    assert stats["items"] == total + 2
+    assert stats["batches"] < total / 10
+    assert stats["max_batch_size"] <= 50
+
+    counters = await get_user_refferal_counters(head.id, file_async_session)
+    assert counters.refferals_count == total // 2
+    assert counters.downline_count == total // 2
+    await batcher.close()
+
+
+@pytest.mark.asyncio
+async def test_registration_batch_rolls_back(file_async_session, monkeypatch):
+    head = await add_user(
+        Users(username="rollhead", password="head", email="rh@gmail.com"),
+        file_async_session,
+    )
+
+    async def fail_link(*args):
+        raise RuntimeError("link failed")
+
+    monkeypatch.setattr("app.models.queries._link_refferals", fail_link)
+    with pytest.raises(RuntimeError, match="link failed"):
+        await add_users_batch(
+            file_async_session,
+            [
+                (
+                    Users(
+                        username=f"rolled{i}",
+                        password="hash",
+                        email=f"rolled{i}@gmail.com",
+                    ),
+                    head.id,
+                )
+                for i in range(3)
+            ],
+        )
+    async with file_async_session() as session:
+        res = await session.execute(select(func.count()).select_from(Users))
+        assert res.scalar() == 1
+
+
+@pytest.mark.asyncio
+async def test_import_chunk_rolls_back(file_async_session, monkeypatch):
+    head = await add_user(
+        Users(username="importhead", password="head", email="ih@gmail.com"),
+        file_async_session,
+    )
+    ref_code = create_access_token({"email": "ih@gmail.com"})
+    async with file_async_session() as session:
+        async with session.begin():
+            session.add(RefferalCode(code=ref_code, user_id=head.id))
+
+    async def fail_link(*args):
+        raise RuntimeError("link failed")
+
+    monkeypatch.setattr("app.models.queries._link_refferals", fail_link)
+    with pytest.raises(RuntimeError, match="link failed"):
+        await import_users_chunk(
+            [
+                {
+                    "username": f"imported{i}",
+                    "password": "hash",
+                    "email": f"imported{i}@gmail.com",
+                    "refferal_code": ref_code if i % 2 else None,
+                }
+                for i in range(4)
+            ],
+            file_async_session,
+        )
+    async with file_async_session() as session:
+        res = await session.execute(select(func.count()).select_from(Users))
+        assert res.scalar() == 1
+
+
+def test_metrics(client):
+    client.get("/api/refferal/id/1")
+    client.get("/api/refferal/email/email1@gmail.com")
+    client.get("/api/refferal/email/email1@gmail.com")
+    res = client.get("/metrics")
+    assert res.status_code == 200
+    assert res.headers["content-type"].startswith("text/plain")
+    body = res.text
+    assert (
+        'http_request_duration_seconds_count{method="GET",'
+        'route="/api/refferal/id/{id}",status="200"}'
+    ) in body
+    assert (
+        'http_request_duration_seconds_bucket{method="GET",'
+        'route="/api/refferal/id/{id}",status="200",le="+Inf"}'
+    ) in body
+    assert "# TYPE cache_hits_total counter" in body
+    assert 'cache_hits_total{cache="refferal_code"}' in body
+    assert 'cache_misses_total{cache="principal"}' in body
+    assert "# TYPE password_pool_pending gauge" in body
+
+
+@pytest.mark.asyncio
+async def test_db_statement_metrics():
+    engine = create_engine("sqlite+aiosqlite://", name="metrics-test")
+    async with engine.connect() as conn:
+        await conn.execute(text("SELECT 1"))
+        await conn.execute(text("  select 2"))
+    assert db_statement_duration.count("metrics-test", "SELECT") == 2
+    await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_slow_query_log(monkeypatch, caplog, tmp_path):
+    monkeypatch.setattr("app.profiling.QUERY_SLOW_MS", 1e-9)
+    engine = create_engine("sqlite+aiosqlite://", name="slow-test")
+
+    async def run(secret: str):
+        async with engine.connect() as conn:
+            await conn.execute(text("SELECT :secret"), {"secret": secret})
+
+    path = tmp_path / "slow.log"
+    configure_slow_log(str(path))
+    try:
+        with caplog.at_level("WARNING"):
+            await run("$2b$12$filed")
+    finally:
+        configure_slow_log(None)
+    assert "SELECT ?" in path.read_text()
+    assert "$2b$12$filed" in path.read_text()
+    assert "$2b$12$filed" not in caplog.text
+
+    # Without a dedicated file the statement reaches the app log, but its
+    # parameters do not.
+    caplog.clear()
+    with caplog.at_level("WARNING", logger="app.slow_queries"):
+        await run("$2b$12$hash")
+    await engine.dispose()
+    assert "SELECT ?" in caplog.text
+    assert "$2b$12$hash" not in caplog.text
+
+
+def test_query_counts_per_endpoint(client, query_counter):
+    client.get("/api/refferal/id/1")
+    client.get("/api/refferal/count/1")
+    query_counter.assert_max("GET /api/refferal/id/{id}", 2)
+    assert query_counter.count("GET /api/refferal/count/{id}") == 1
+
+
+@pytest.mark.query_budget(max=2, route="GET /api/refferal/downline/{id}")
+def test_downline_query_budget(client):
+    res = client.get("/api/refferal/downline/1?depth=3&members=true")
+    assert res.status_code == 200
+
+
+def test_query_budget_fail_mode(client, monkeypatch):
+    monkeypatch.setattr(profiler, "mode", "fail")
+    monkeypatch.setattr(profiler, "budgets", {"GET /api/refferal/id/{id}": 1})
+    profiles = []
+    with profiler.recording(profiles.append):
+        with pytest.raises(QueryBudgetExceeded):
+            client.get("/api/refferal/id/1")
+        assert client.get("/api/refferal/count/1").status_code == 200
+    assert [p.statements for p in profiles] == [1, 1]
+
+    profile = RequestProfile({"method": "GET", "path": "/"})
+    for id in range(3):
+        profile.record("SELECT * FROM users WHERE id = ?", 0.001)
+    profile.record("SELECT 1", 0.001)
+    assert profile.repeated(3) == [("SELECT * FROM users WHERE id = ?", 3)]
+
+
+@pytest.mark.asyncio
+async def test_conditional_get(client, async_session, query_counter):
+    res = client.get("/api/refferal/id/1")
+    etag = res.headers["ETag"]
+    assert res.headers["Cache-Control"] == "no-cache"
+    cached = client.get("/api/refferal/id/1", headers={"If-None-Match": etag})
+    assert cached.status_code == 304
+    assert cached.content == b""
+    assert query_counter.count("GET /api/refferal/id/{id}") == 1
+    weak = client.get(
+        "/api/refferal/id/1", headers={"If-None-Match": f'"x", W/{etag}'}
+    )
+    assert weak.status_code == 304
+
+    by_email = client.get("/api/refferal/email/email1@gmail.com")
+    email_etag = by_email.headers["ETag"]
+    assert (
+        client.get(
+            "/api/refferal/email/email1@gmail.com",
+            headers={"If-None-Match": email_etag},
+        ).status_code
+        == 304
+    )
+
+    root = ActiveUser(id=1, username="username1", email="email1@gmail.com")
+    await add_user_and_ref(
+        root,
+        Users(username="etag1", password="e1", email="etag1@gmail.com"),
+        async_session,
+    )
+    changed = client.get("/api/refferal/id/1", headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
+    assert "etag1" in [ref["username"] for ref in changed.json()["refferals"]]
+    assert (
+        client.get(
+            "/api/refferal/email/email1@gmail.com",
+            headers={"If-None-Match": email_etag},
+        ).status_code
+        == 200
+    )
+
+
+@pytest.mark.asyncio
+async def test_conditional_get_by_email_needs_live_code(client, async_session):
+    email = "etagcode@gmail.com"
+    created = await add_user(
+        Users(username="etagcode", password="ec", email=email), async_session
+    )
+    url = f"/api/refferal/email/{email}"
+    any_tag = {"If-None-Match": "*"}
+    assert client.get(url, headers=any_tag).status_code == 404
+
+    principal = ActiveUser(id=created.id, username="etagcode", email=email)
+    code = create_access_token({"email": email}, timedelta(seconds=2))
+    assert await add_refferal_code_to_user(principal, code, async_session)
+    res = client.get(url)
+    etag = res.headers["ETag"]
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
+    assert client.get(url, headers=any_tag).status_code == 304
+
+    # Expiry does not bump the version, but the old tag stops matching.
+    time.sleep(2.1)
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 404
+    assert client.get(url, headers=any_tag).status_code == 404
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=1, burst=2, max_keys=2)
+    assert bucket.acquire("a") == 0
+    assert bucket.acquire("a") == 0
+    assert 0 < bucket.acquire("a") <= 1
+    assert bucket.acquire("b") == 0
+    bucket.acquire("c")
+    assert len(bucket) == 2
+    assert TokenBucket(rate=0, burst=1).acquire("a") == 0
+
+
+def test_admission_control(client, monkeypatch):
+    monkeypatch.setattr(
+        login_admission, "per_username", TokenBucket(rate=0.01, burst=1)
+    )
+    form = {"username": "username2", "password": "wrong"}
+    assert client.post("/api/accounts/login", data=form).status_code == 401
+    res = client.post("/api/accounts/login", data=form)
+    assert res.status_code == 429
+    assert int(res.headers["Retry-After"]) >= 1
+    assert admission_rejections.value("login", "username_rate") == 1
+
+    limiter = register_admission.limiter
+    assert limiter.active == 0
+    monkeypatch.setattr(limiter, "active", limiter.limit)
+    res = client.post(
+        "/api/accounts/register/",
+        json={
+            "username": "shedded",
+            "email": "shedded@gmail.com",
+            "password": "password",
+        },
+    )
+    assert res.status_code == 503
+    assert res.headers["Retry-After"] == "1"
+    assert limiter.active == limiter.limit
+    assert admission_rejections.value("register", "concurrency") == 1
+
+
+def test_per_worker_limits():
+    limits = per_worker_limits(4)
+    assert float(limits["AUTH_RATE_PER_USERNAME"]) * 4 == pytest.approx(
+        login_admission.per_username.rate
+    )
+    assert float(limits["AUTH_BURST_PER_IP"]) * 4 == pytest.approx(
+        login_admission.per_ip.burst
+    )
+    assert per_worker_limits(1)["AUTH_RATE_PER_IP"] == str(
+        login_admission.per_ip.rate
+    )
+
+
+def test_calibrate_rounds():
+    rounds = calibrate_rounds("bcrypt", 0.005)
+    assert 4 <= rounds <= 10
+    assert calibrate_rounds("bcrypt", 0.005, min_rounds=6) >= 6
+    assert calibrate_rounds("pbkdf2_sha256", 0.005) >= 1
+
+
+@pytest.mark.asyncio
+async def test_rehash_on_login(client, async_session, monkeypatch):
+    # Earlier tests have already drawn on the shared login buckets.
+    monkeypatch.setattr(login_admission, "per_ip", TokenBucket(1, burst=10))
+    monkeypatch.setattr(
+        login_admission, "per_username", TokenBucket(1, burst=10)
+    )
+
+    async def stored_hash():
+        async with async_session() as session:
+            res = await session.execute(
+                select(Users.password).where(Users.username == "username3")
+            )
+            return res.scalar_one()
+
+    weak_hash = (
+        get_pwd_context().handler("bcrypt").using(rounds=4).hash("password")
+    )
+    async with async_session() as session:
+        async with session.begin():
+            await session.execute(
+                update(Users)
+                .where(Users.username == "username3")
+                .values(password=weak_hash)
+            )
+    configure_hashing(["bcrypt"], 5)
+    try:
+        form = {"username": "username3", "password": "password"}
+        assert client.post("/api/accounts/login", data=form).status_code == 200
+        new_hash = await stored_hash()
+        assert new_hash.startswith("$2b$05$")
+        assert client.post("/api/accounts/login", data=form).status_code == 200
+        assert await stored_hash() == new_hash
+        # A worker configured one step lower keeps the stronger hash.
+        configure_hashing(["bcrypt"], 4)
+        assert client.post("/api/accounts/login", data=form).status_code == 200
+        assert await stored_hash() == new_hash
+    finally:
+        configure_hashing(["bcrypt"])